@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compare the lookup-table labeling of lib.noteshrink.apply_palette with the plain scipy vq() path on letter sized
+pages at 300 and 600 dpi. The foreground mask (table lookup vs. rgb_to_sv), the labeling step alone (all foreground
+pixels) and the complete apply_palette() call are timed.
+'''
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.cluster.vq import vq
+
+from common import synthetic_page, default_options, best_of
+from lib.noteshrink import sample_pixels, get_palette, get_fg_mask, get_fg_mask_sv, apply_palette, get_palette_lut, \
+    get_lut_index
+
+
+def label_lut(pixels, palette):
+    labels = get_palette_lut(palette)[get_lut_index(pixels)]
+    unresolved = np.flatnonzero(labels == 255)
+    if len(unresolved):
+        labels[unresolved], _ = vq(pixels[unresolved], palette)
+    return labels
+
+
+def main():
+    options = default_options()
+    for dpi in (300, 600):
+        img = synthetic_page(dpi)
+        palette = get_palette(sample_pixels(img, options), options)
+        fg_pixels = img.reshape((-1, 3))[get_fg_mask(palette[0], img, options).flatten()]
+        print('{0} dpi ({1}x{2}), {3} foreground pixels'.format(dpi, img.shape[1], img.shape[0], len(fg_pixels)))
+
+        t_sv, mask_sv = best_of(lambda: get_fg_mask_sv(palette[0], img, options))
+        t_lut, mask_lut = best_of(lambda: get_fg_mask(palette[0], img, options))
+        assert np.array_equal(mask_sv, mask_lut), 'foreground mask differs from rgb_to_sv'
+        print('  fg mask:       rgb_to_sv {0:.3f} s, lookup table {1:.3f} s, speedup {2:.1f}x'.format(
+            t_sv, t_lut, t_sv / t_lut))
+
+        t_vq, labels_vq = best_of(lambda: vq(fg_pixels, palette)[0])
+        t_lut, labels_lut = best_of(lambda: label_lut(fg_pixels, palette))
+        assert np.array_equal(labels_vq, labels_lut), 'lookup table result differs from vq'
+        print('  labeling:      vq {0:.3f} s, lookup table {1:.3f} s, speedup {2:.1f}x'.format(
+            t_vq, t_lut, t_vq / t_lut))
+
+        t_vq, labels_vq = best_of(lambda: apply_palette(img, palette, options, use_lut=False))
+        t_lut, labels_lut = best_of(lambda: apply_palette(img, palette, options, use_lut=True))
+        assert np.array_equal(labels_vq, labels_lut), 'lookup table result differs from vq'
+        print('  apply_palette: vq {0:.3f} s, lookup table {1:.3f} s, speedup {2:.1f}x'.format(
+            t_vq, t_lut, t_vq / t_lut))
+
+
+if __name__ == '__main__':
+    main()
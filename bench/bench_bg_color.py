@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compare lib.noteshrink.get_bg_color (18 bit bin index counted with np.bincount) on multi-million pixel samples with
+
+- the original implementation of noteshrink (quantize and pack to int64, then np.unique), the baseline
+- get_bg_color_unique (np.unique on the colors packed to uint32 by the current quantize/pack_rgb)
+
+The gain over the baseline (about 2.5x on 0.4 million, 3.5-4x on 2-34 million samples) comes from never widening
+the colors to int64. np.unique on the packed uint32 colors is faster still, the bincount reaches 0.6-0.9x of its
+speed.
+'''
+
+from __future__ import print_function
+
+import numpy as np
+
+from common import synthetic_page, best_of
+from lib.noteshrink import get_bg_color, get_bg_color_unique, unpack_rgb
+
+
+def get_bg_color_int64(image, bits_per_channel=6):
+    '''
+    The original get_bg_color of noteshrink.
+    '''
+    shift = 8 - bits_per_channel
+    halfbin = (1 << shift) >> 1
+    quantized = ((image.astype(int) >> shift) << shift) + halfbin
+    rgb = quantized.astype(int).reshape((-1, 3))
+    packed = rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2]
+    unique, counts = np.unique(packed, return_counts=True)
+    return unpack_rgb(unique[counts.argmax()])
+
+
+def main():
+    for dpi in (300, 600):
+        pixels = synthetic_page(dpi).reshape((-1, 3))
+        for fraction in (0.05, 0.25, 1.0):
+            samples = pixels[:int(len(pixels) * fraction)]
+            t_int64, bg_int64 = best_of(lambda: get_bg_color_int64(samples, 6))
+            t_unique, bg_unique = best_of(lambda: get_bg_color_unique(samples, 6))
+            t_bincount, bg_bincount = best_of(lambda: get_bg_color(samples, 6))
+            assert tuple(bg_int64) == tuple(bg_unique) == tuple(bg_bincount), 'results differ'
+            print('{0:>9} samples: baseline (int64 np.unique) {1:.3f} s, uint32 np.unique {2:.3f} s, '
+                  'bincount {3:.3f} s, speedup {4:.1f}x over the baseline, {5:.1f}x over uint32 np.unique'.format(
+                      len(samples), t_int64, t_unique, t_bincount, t_int64 / t_bincount, t_unique / t_bincount))
+
+
+if __name__ == '__main__':
+    main()
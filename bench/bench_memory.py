@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Peak memory of the compact quantize/pack_rgb/unpack_rgb kernels of lib.noteshrink compared with the former int64
+versions on full-size pages. Every variant runs in a fresh subprocess which reads the raw page from a file, so the
+peak RSS (resource.getrusage) only contains the interpreter, the page and the variant itself. The pages are
+created in a subprocess as well: on linux the peak RSS of the parent is inherited through fork/exec. Unix only.
+'''
+
+from __future__ import print_function
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from common import synthetic_page
+from lib.noteshrink import quantize, pack_rgb, unpack_rgb
+
+
+def legacy_quantize(image, bits_per_channel=6):
+    shift = 8 - bits_per_channel
+    halfbin = (1 << shift) >> 1
+    return ((image.astype(int) >> shift) << shift) + halfbin
+
+
+def legacy_pack_rgb(rgb):
+    orig_shape = rgb.shape[:-1]
+    rgb = rgb.astype(int).reshape((-1, 3))
+    return (rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2]).reshape(orig_shape)
+
+
+def legacy_unpack_rgb(packed):
+    orig_shape = packed.shape
+    packed = packed.reshape((-1, 1))
+    return np.hstack(((packed >> 16) & 0xff, (packed >> 8) & 0xff, packed & 0xff)).reshape(orig_shape + (3,))
+
+
+# name > (legacy function, compact function), both take the page
+VARIANTS = {
+    'quantize': (legacy_quantize, quantize),
+    'pack_rgb': (legacy_pack_rgb, pack_rgb),
+    'quantize+pack_rgb': (lambda page: legacy_pack_rgb(legacy_quantize(page)),
+                          lambda page: pack_rgb(quantize(page, out=page))),
+    'pack+unpack_rgb': (lambda page: legacy_unpack_rgb(legacy_pack_rgb(page)),
+                        lambda page: unpack_rgb(pack_rgb(page))),
+}
+
+
+def peak_rss():
+    '''
+    :return: peak resident set size of this process in bytes
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024   # kilobytes on linux
+
+
+def child(name, implementation, path, height, width):
+    '''
+    Executed in the subprocess: print the additional peak memory of one variant in bytes.
+    '''
+    page = np.empty((int(height), int(width), 3), dtype=np.uint8)
+    with open(path, 'rb') as f:
+        f.readinto(page.data)   # no temporary copy (unlike np.load), the baseline is the page itself
+    baseline = peak_rss()
+    VARIANTS[name][implementation == 'compact'](page)
+    print(peak_rss() - baseline)
+
+
+def create_page(dpi, path):
+    '''
+    Executed in a subprocess: write a synthetic page as raw bytes to path and print its shape.
+    '''
+    page = synthetic_page(int(dpi))
+    page.tofile(path)
+    print(page.shape[0], page.shape[1])
+
+
+def measure(name, implementation, path, shape):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', name, implementation,
+                                      path, str(shape[0]), str(shape[1])])
+    return int(output.decode('ascii').split()[-1])
+
+
+def main():
+    tmpdir = tempfile.mkdtemp(prefix='noteshrinker-bench-')
+    try:
+        for dpi in (300, 600):
+            path = os.path.join(tmpdir, 'page{0}.raw'.format(dpi))
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--page', str(dpi), path])
+            shape = [int(value) for value in output.decode('ascii').split()[-2:]]
+            print('{0} dpi page, {1:.0f} MB'.format(dpi, os.path.getsize(path) / 1e6))
+            for name in sorted(VARIANTS):
+                legacy = measure(name, 'legacy', path, shape)
+                compact = measure(name, 'compact', path, shape)
+                print('  {0:<18} legacy {1:6.0f} MB, compact {2:6.0f} MB, reduction {3:.1f}x'.format(
+                    name, legacy / 1e6, compact / 1e6, legacy / float(max(compact, 1024 * 1024))))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 7 and sys.argv[1] == '--child':
+        child(*sys.argv[2:])
+    elif len(sys.argv) == 4 and sys.argv[1] == '--page':
+        create_page(*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compare the PDF export of the GUI before (QPrinter/QPainter.drawImage, the page is rasterized as RGB image) and now
+(lib.PdfWriter, the label/palette pair is embedded as indexed image with 1, 2, 4 or 8 bits per pixel). File size
+and export time of one A4 page are printed for several palette sizes. Needs PyQt4 (a QApplication is created for
+QPrinter).
+'''
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QApplication, QPainter, QPrinter
+
+from common import synthetic_page, default_options, best_of
+from lib.noteshrink import sample_pixels, get_palette, apply_palette, finalize_palette, labels_to_qimage
+from lib.PdfWriter import PdfWriter, A4, bit_depth
+
+
+def export_qprinter(labels, palette, filename):
+    image = labels_to_qimage(labels, palette)
+    printer = QPrinter()
+    printer.setPageSize(QPrinter.A4)
+    printer.setOutputFormat(QPrinter.PdfFormat)
+    printer.setOutputFileName(filename)
+    painter = QPainter(printer)
+    painter.setRenderHint(QPainter.Antialiasing)
+    rect = painter.viewport()
+    size = image.size()
+    size.scale(rect.size(), Qt.KeepAspectRatio)
+    painter.setViewport(rect.x(), rect.y(), size.width(), size.height())
+    painter.setWindow(image.rect())
+    painter.drawImage(0, 0, image)
+    painter.end()
+
+
+def export_indexed(labels, palette, filename):
+    pdf = PdfWriter(filename)
+    pdf.add_page(labels, palette, page_size=A4)
+    pdf.close()
+
+
+def main():
+    app = QApplication(sys.argv)
+    tmpdir = tempfile.mkdtemp(prefix='noteshrinker-bench-')
+    try:
+        img = synthetic_page(300)
+        for num_colors in (2, 4, 8, 16):
+            options = default_options(num_colors=num_colors)
+            palette = get_palette(sample_pixels(img, options), options)
+            labels = apply_palette(img, palette, options)
+            palette = finalize_palette(palette, options)
+            print('{0} colors ({1} bits per pixel)'.format(num_colors, bit_depth(len(palette))))
+            sizes = {}
+            for name, export in (('QPrinter', export_qprinter), ('indexed', export_indexed)):
+                filename = os.path.join(tmpdir, name + '.pdf')
+                elapsed, _ = best_of(lambda: export(labels, palette, filename))
+                sizes[name] = os.path.getsize(filename)
+                print('  {0:<9} {1:7.3f} s, {2:9.0f} kB'.format(name, elapsed, sizes[name] / 1024.0))
+            print('  size ratio {0:.1f}x'.format(sizes['QPrinter'] / float(sizes['indexed'])))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    del app
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compare the pixel sampling of lib.noteshrink.sample_pixels ("random" and "stride") with the former full permutation
+of all pixel indices. The page is a non-contiguous view, like the arrays lib.qimage2ndarray.rgb_view returns.
+'''
+
+from __future__ import print_function
+
+import numpy as np
+
+from common import synthetic_page, default_options, best_of
+from lib.noteshrink import sample_pixels, SAMPLE_METHODS
+
+
+def sample_permutation(img, options):
+    pixels = img.reshape((-1, 3))
+    idx = np.arange(pixels.shape[0])
+    np.random.shuffle(idx)
+    return pixels[idx[:int(pixels.shape[0] * options.sample_fraction)]]
+
+
+def main():
+    for dpi in (300, 600):
+        page = synthetic_page(dpi)
+        bgra = np.zeros(page.shape[:2] + (4,), dtype=np.uint8)
+        bgra[:, :, :3] = page
+        img = bgra[:, :, :3]
+        print('{0} dpi ({1}x{2})'.format(dpi, img.shape[1], img.shape[0]))
+        t_perm, _ = best_of(lambda: sample_permutation(img, default_options()))
+        print('  permutation {0:.3f} s'.format(t_perm))
+        for method in sorted(SAMPLE_METHODS):
+            options = default_options(sample_method=method, sample_seed=0)
+            elapsed, samples = best_of(lambda: sample_pixels(img, options))
+            assert np.array_equal(samples, sample_pixels(img, options)), 'sampling is not reproducible'
+            print('  {0:<11} {1:.3f} s, speedup {2:.1f}x'.format(method, elapsed, t_perm / elapsed))
+
+
+if __name__ == '__main__':
+    main()
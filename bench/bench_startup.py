@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Startup time of the GUI. Every measurement runs in a fresh interpreter:
+
+- registering the icons from res/resources.rcc (res.register_resources) compared with importing the pyrcc module
+  res.res, which the GUI did before
+- the complete startup of noteshrinker-qt.py --startup-timing: end of the imports, window created and first paint
+  (seconds since the script started) and the wall time of the whole process
+
+Needs PyQt4 and a display (e.g. "xvfb-run python bench/bench_startup.py"). With --max-first-paint the script exits
+with 1 when the median time to the first paint is above the given seconds, to catch regressions.
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESOURCE_VARIANTS = {
+    'res.res': 'import res.res',
+    'resources.rcc': 'import res; assert res.register_resources() == "rcc"',
+}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_statement(statement):
+    '''
+    :return: seconds of the statement in a fresh interpreter (without the interpreter startup)
+    '''
+    code = 'import time; t = time.time(); {0}; print(time.time() - t)'.format(statement)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return float(output.decode('ascii').strip().splitlines()[-1])
+
+
+def time_gui():
+    '''
+    :return: dict of the startup times printed by the GUI, plus "process" (wall time of the whole process)
+    '''
+    start = time.time()
+    output = subprocess.check_output([sys.executable, os.path.join(ROOT, 'noteshrinker-qt.py'), '--startup-timing'],
+                                     cwd=ROOT)
+    elapsed = time.time() - start
+    lines = [line for line in output.decode('utf-8').splitlines() if line.startswith('{')]
+    times = json.loads(lines[-1])
+    times['process'] = elapsed
+    return times
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-r', '--runs', type=int, default=5, help='runs per measurement (the median is shown)')
+    parser.add_argument('--max-first-paint', type=float, default=None, metavar='SECONDS',
+                        help='exit with 1 if the median time to the first paint is larger')
+    args = parser.parse_args()
+
+    time_statement('pass')   # fills the bytecode caches (__pycache__/.pyc) of both variants
+    for name in sorted(RESOURCE_VARIANTS):
+        time_statement(RESOURCE_VARIANTS[name])
+    print('registering the resources')
+    for name in sorted(RESOURCE_VARIANTS):
+        elapsed = median([time_statement(RESOURCE_VARIANTS[name]) for _ in range(args.runs)])
+        print('  {0:<14} {1:7.1f} ms'.format(name, elapsed * 1000))
+
+    runs = [time_gui() for _ in range(args.runs)]
+    print('GUI startup (resources: {0})'.format(runs[0]['resources']))
+    result = {}
+    for name in ('imports', 'window', 'first_paint', 'process'):
+        result[name] = median([times[name] for times in runs])
+        print('  {0:<14} {1:7.1f} ms'.format(name, result[name] * 1000))
+
+    if args.max_first_paint is not None and result['first_paint'] > args.max_first_paint:
+        print('first paint after {0:.3f} s, the budget is {1:.3f} s'.format(result['first_paint'],
+                                                                          args.max_first_paint))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
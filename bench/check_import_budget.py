@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Check the import budget of the GUI (see README.md): noteshrinker-qt.py is imported in a fresh interpreter (as
+module, the window is not created) and
+
+- none of the modules of the processing core (FORBIDDEN) may be imported, they are loaded on first use or by the
+  prewarm thread after the first paint
+- the imports must not take longer than the budget (median of several runs)
+
+Exits with 1 if the budget is exceeded, so it can be used as a test. Needs PyQt4.
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'noteshrinker-qt.py')
+
+IMPORT_BUDGET = 0.5   # seconds for the imports of noteshrinker-qt.py (warm bytecode cache)
+FORBIDDEN = ('numpy', 'scipy', 'lib.noteshrink', 'lib.BatchEngine', 'lib.PdfWriter', 'lib.PngWriter',
+             'lib.qimage2ndarray', 'res.res')
+
+CHILD = '''
+import json, runpy, sys, time
+sys.argv = [{script!r}]
+start = time.time()
+runpy.run_path({script!r}, run_name='noteshrinker_qt')
+print(json.dumps({{'seconds': time.time() - start, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def measure():
+    '''
+    :return: tuple (seconds, list of the imported module names)
+    '''
+    output = subprocess.check_output([sys.executable, '-c', CHILD.format(script=SCRIPT)], cwd=ROOT)
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return result['seconds'], result['modules']
+
+
+def main():
+    parser = ArgumentParser(description='check the import budget of the GUI')
+    parser.add_argument('-r', '--runs', type=int, default=5, help='runs (the median is compared with the budget)')
+    parser.add_argument('-b', '--budget', type=float, default=IMPORT_BUDGET, metavar='SECONDS',
+                        help='import budget (default %(default)s)')
+    args = parser.parse_args()
+
+    measure()   # fills the bytecode caches
+    runs = [measure() for _ in range(args.runs)]
+    seconds = sorted(elapsed for elapsed, _ in runs)[len(runs) // 2]
+    modules = runs[0][1]
+    loaded = [name for name in FORBIDDEN if name in modules]
+
+    print('imports of noteshrinker-qt.py: {0:.3f} s (budget {1:.3f} s), {2} modules'.format(
+        seconds, args.budget, len(modules)))
+    failed = False
+    if loaded:
+        print('FAIL: imported at startup: {0}'.format(', '.join(loaded)))
+        failed = True
+    if seconds > args.budget:
+        print('FAIL: the imports take {0:.3f} s longer than the budget'.format(seconds - args.budget))
+        failed = True
+    if not failed:
+        print('OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
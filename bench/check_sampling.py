@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Check that every pixel sampling method (lib.noteshrink.SAMPLE_METHODS, the -m option) runs: each one samples a page
+once as a whole (sample_pixels) and once strip by strip (sample_pixels_strips), with the random generator of
+get_rng() and with the legacy RandomState. The samples must have the requested count and be reproducible.
+
+Exits with 1 if a method fails, so it can be used as a test. Needs PyQt4 (lib.noteshrink imports it).
+'''
+
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+from common import synthetic_page, default_options
+from lib.noteshrink import SAMPLE_METHODS, sample_pixels, sample_pixels_strips
+
+
+def check(method, img):
+    '''
+    :return: list of error messages (empty if the method works)
+    '''
+    errors = []
+    options = default_options(sample_method=method, sample_seed=0)
+    expected = int(img.shape[0] * img.shape[1] * options.sample_fraction)
+    runs = [('sample_pixels', lambda: sample_pixels(img, options)),
+            ('sample_pixels RandomState', lambda: sample_pixels(img, options, np.random.RandomState(0))),
+            ('sample_pixels_strips', lambda: sample_pixels_strips(img, options, 256))]
+    for name, run in runs:
+        try:
+            samples = run()
+        except Exception as e:
+            errors.append('{0}: {1}: {2}'.format(name, type(e).__name__, e))
+            continue
+        if samples.ndim != 2 or samples.shape[1] != 3 or abs(len(samples) - expected) > 0.1 * expected:
+            errors.append('{0}: {1} samples, expected about {2}'.format(name, samples.shape, expected))
+        elif name != 'sample_pixels RandomState' and not np.array_equal(samples, run()):
+            errors.append('{0}: not reproducible'.format(name))
+    return errors
+
+
+def main():
+    img = synthetic_page(300)[:1000]
+    failed = False
+    for method in sorted(SAMPLE_METHODS):
+        errors = check(method, img)
+        print('{0:<8} {1}'.format(method, 'OK' if not errors else 'FAIL'))
+        for error in errors:
+            print('  ' + error)
+        failed = failed or bool(errors)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
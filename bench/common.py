@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Helpers shared by the benchmark scripts in this folder. The scripts are run directly, e.g.
+
+    python bench/bench_apply_palette.py
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # make "lib" importable
+
+import lib.OutputWriter as OutputWriter
+
+# page sizes (width, height) of a letter sized scan
+PAGE_SIZES = {300: (2550, 3300), 600: (5100, 6600)}
+
+
+def synthetic_page(dpi=300, seed=0):
+    '''
+    Create a scan-like RGB page: a slightly noisy, yellowish background with a few thousand colored strokes.
+    :param dpi: 300 or 600 (see PAGE_SIZES)
+    :return: uint8 array of shape (height, width, 3)
+    '''
+    rng = np.random.RandomState(seed)
+    width, height = PAGE_SIZES[dpi]
+    page = np.empty((height, width, 3), dtype=np.uint8)
+    page[:] = (238, 232, 214)
+    noise = rng.randint(-6, 7, size=(height, width, 1)).astype(np.int16)
+    page[:] = np.clip(page + noise, 0, 255)
+    ink = np.array([(20, 20, 30), (30, 40, 160), (170, 30, 30), (40, 120, 50)], dtype=np.uint8)
+    stroke = max(2, dpi // 100)
+    for _ in range(4000):
+        y = rng.randint(0, height - stroke)
+        x = rng.randint(0, width - 60)
+        page[y:y + stroke, x:x + rng.randint(10, 60)] = ink[rng.randint(len(ink))]
+    return page
+
+
+def default_options(**kwargs):
+    '''
+    :return: Namespace with the defaults of the GUI and the batch mode (lib.OutputWriter.default_options), quiet
+             unless kwargs say otherwise, updated with kwargs
+    '''
+    kwargs.setdefault('quiet', True)
+    return OutputWriter.default_options(**kwargs)
+
+
+def best_of(function, repeat=3):
+    '''
+    :return: tuple (smallest wall time of "repeat" calls in seconds, result of the last call)
+    '''
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Fans the pages of an output run out to a pool of worker processes. Every worker runs the complete noteshrink
+pipeline (lib.noteshrink.render_page) for one page and sends back the label/palette arrays, the results are
+handed back to the caller in the original order of the workbench.
+'''
+
+import hashlib
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+import lib.Instrumentation as Instrumentation
+from lib.noteshrink import render_page, worker_pool
+from lib.RenderCache import disk_key, labels_cache
+
+
+def _render_job(job):
+    '''
+    Executed inside a worker process. Must be a module-level function, otherwise it could not be pickled.
+    :param job: tuple (index, input_filename, height, options, cache_dir, palette)
+    :return: tuple (index, labels, palette, events), events of lib.Instrumentation (ending with the "render" event
+             of the whole job, with the peak RSS of the worker so far), they are dispatched in the calling process
+    '''
+    index, input_filename, height, options, cache_dir, palette = job
+    with Instrumentation.capture() as events, Instrumentation.for_page(input_filename):
+        with Instrumentation.timer('render', cached=0) as counters:
+            labels = None
+            if cache_dir is not None:
+                cache = labels_cache(cache_dir)   # one per worker, not a directory walk per page
+                kind = 'labels'
+                if palette is not None:
+                    kind = 'labels:' + hashlib.md5(palette.tobytes()).hexdigest()   # labels of a given palette
+                key = disk_key(input_filename, options, kind, height)
+                arrays = cache.get_arrays(key)
+                if arrays is not None:
+                    labels, palette = arrays['labels'], arrays['palette']
+                    counters['cached'] = 1
+            if labels is None:
+                labels, palette = render_page(input_filename, height, options, palette=palette)
+                if cache_dir is not None:
+                    cache.put_arrays(key, labels=labels, palette=palette)
+            counters['pixels'] = labels.size
+            peak = Instrumentation.max_rss()
+            if peak is not None:
+                counters['peak_rss'] = peak   # the pool only lives for one run, see lib.RunReport
+    return index, labels, palette, events
+
+
+def _render_chunk(jobs):
+    '''
+    Executed inside a worker process: several jobs at once (see BatchEngine chunksize).
+    :return: list of the results of _render_job
+    '''
+    return [_render_job(job) for job in jobs]
+
+
+def bounded_imap(pool, function, jobs, window):
+    '''
+    Like pool.imap (results in the order of the jobs), but at most window jobs are submitted and not yet fetched.
+    pool.imap would queue all jobs at once, the results of the workers would then pile up in the calling process
+    while the caller is still busy with an earlier one.
+    :param window: maximum number of jobs in flight (queued, running or finished but not fetched)
+    :return: generator of the results
+    '''
+    jobs = iter(jobs)
+    pending = deque(pool.apply_async(function, (job,)) for job in islice(jobs, window))
+    while pending:
+        result = pending.popleft().get()
+        for job in islice(jobs, 1):   # keep the workers busy while the caller handles the result
+            pending.append(pool.apply_async(function, (job,)))
+        yield result
+
+
+class BatchEngine(object):
+
+    """
+    Render a list of pages in parallel.
+
+        engine = BatchEngine(workers=4)
+        for index, labels, palette in engine.imap(options_list, progress=callback):
+            ...
+
+    Results are yielded in the order of the input list, no matter which worker finishes first. At most
+    2 * workers chunks are in flight, so only a few finished pages wait for the caller. With workers=1 no pool is
+    created and everything is computed in the calling thread.
+    """
+
+    def __init__(self, workers=None, chunksize=1, cache_dir=None):
+        '''
+        :param workers: number of worker processes, None for one per cpu core
+        :param chunksize: number of pages handed to a worker at once (larger values reduce the ipc overhead for
+                          many small pages, but make the progress coarser and keep more pages in memory)
+        :param cache_dir: directory of a DiskCache for the results, None to disable the cache
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = max(1, int(workers))
+        self.chunksize = max(1, int(chunksize))
+        self.cache_dir = cache_dir
+
+    def imap(self, options_list, height=-1, progress=None, palette=None):
+        '''
+        Render the first filename of every options object.
+        :param options_list: list of Namespace objects (one per page)
+        :param height: maximum height of the results, -1 for full size
+        :param progress: callable(done, total), called in the calling thread after every finished page
+        :param palette: palette for all pages (see lib.noteshrink.get_global_palette), None to compute one per page
+        :return: generator of tuples (index, labels, palette), ordered like options_list
+        '''
+        jobs = [(index, options.filenames[0], height, options, self.cache_dir, palette)
+                for index, options in enumerate(options_list)]
+        total = len(jobs)
+        if total == 0:
+            return
+
+        workers = min(self.workers, total)
+        if workers == 1:
+            results = (_render_job(job) for job in jobs)
+            pool = None
+        else:
+            pool = worker_pool(workers)   # not forked where possible, see there
+            chunks = [jobs[start:start + self.chunksize] for start in range(0, total, self.chunksize)]
+            results = (result for chunk in bounded_imap(pool, _render_chunk, chunks, 2 * workers)
+                       for result in chunk)
+
+        try:
+            for done, (index, labels, palette, events) in enumerate(results, 1):
+                Instrumentation.dispatch(events)
+                if progress is not None:
+                    progress(done, total)
+                yield index, labels, palette
+        finally:
+            if pool is not None:
+                pool.terminate()   # all results are fetched at this point (or the caller gave up)
+                pool.join()
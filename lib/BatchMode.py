@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Headless batch mode: "noteshrinker-qt.py --batch [options] IMAGE|DIR ...". The pages are written by
+lib.OutputWriter.write_outputs, exactly like the GO! button of the GUI does it, but no window, QApplication,
+translation or resource is loaded. A JSON summary of the run (with the time and counters per stage, see
+lib.Instrumentation) is printed to stdout.
+'''
+
+from __future__ import print_function
+
+import io
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from copy import deepcopy
+
+import lib.Instrumentation as Instrumentation
+from lib.noteshrink import percent, get_filenames, KMEANS_METHODS
+from lib.OutputWriter import default_options, write_outputs
+from lib.RenderCache import DiskCache
+from lib.RunReport import RunReport
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")   # like the file filter of the GUI
+
+
+def get_batch_parser():
+    '''
+    Arguments of the batch mode. The noteshrink settings default to None, only given ones replace the defaults of
+    the GUI (or of the --options file).
+    :return: ArgumentParser
+    '''
+    parser = ArgumentParser(prog='noteshrinker-qt.py --batch',
+                            description='convert scanned, hand-written notes without starting the GUI')
+
+    parser.add_argument('inputs', metavar='IMAGE', nargs='+',
+                        help='image files or directories containing images')
+    parser.add_argument('-d', '--output-dir', dest='output_dir', required=True,
+                        help='directory for the outputs (created if missing)')
+    parser.add_argument('--options', dest='options_file', metavar='JSON', default=None,
+                        help='JSON object with noteshrink settings, e.g. {"num_colors": 4, "white_bg": true}')
+
+    parser.add_argument('-b', dest='basename', default=None,
+                        help='suffix of the output filenames (default _optimized)')
+    parser.add_argument('-n', dest='num_colors', type=int, default=None,
+                        help='number of output colors (default 8)')
+    parser.add_argument('-p', dest='sample_fraction', metavar='PERCENT', type=percent, default=None,
+                        help='%% of pixels to sample (default 5)')
+    parser.add_argument('-v', dest='value_threshold', metavar='PERCENT', type=percent, default=None,
+                        help='background value threshold %% (default 25)')
+    parser.add_argument('-s', dest='sat_threshold', metavar='PERCENT', type=percent, default=None,
+                        help='background saturation threshold %% (default 20)')
+    parser.add_argument('-w', dest='white_bg', action='store_const', const=True, default=None,
+                        help='make background white')
+    parser.add_argument('-S', dest='saturate', action='store_const', const=False, default=None,
+                        help='do not saturate colors')
+    parser.add_argument('-k', dest='kmeans_method', metavar='METHOD', choices=sorted(KMEANS_METHODS),
+                        default=None, help='clustering method, one of ' + ', '.join(sorted(KMEANS_METHODS)) +
+                        ' (default full)')
+    parser.add_argument('-K', dest='sort_numerically', action='store_const', const=False, default=None,
+                        help='keep the pages in the given order (directories are always sorted)')
+
+    parser.add_argument('-g', '--global-palette', dest='global_palette', action='store_const', const=True,
+                        default=None, help='use one palette for all pages')
+    parser.add_argument('--no-images', dest='create_images', action='store_false', default=True,
+                        help='do not write the images')
+    parser.add_argument('--single-pdf', dest='create_single_pdf', action='store_true', default=False,
+                        help='write one PDF per page')
+    parser.add_argument('--merged-pdf', dest='create_merged_pdf', action='store_true', default=False,
+                        help='write all pages into merged.pdf')
+
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=None,
+                        help='number of worker processes (default one per cpu core)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True,
+                        help='compute every page, do not read or write the disk cache')
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                        help='directory of the disk cache (default: the one of the GUI)')
+    parser.add_argument('--report', dest='report', metavar='JSON', default=None,
+                        help='write a performance report of the run (time per stage and page, bytes, peak RSS, '
+                        'worker utilization, see lib/RunReport.py)')
+    parser.add_argument('--report-html', dest='report_html', metavar='HTML', default=None,
+                        help='write the performance report as HTML page, too')
+    return parser
+
+
+def collect_inputs(paths):
+    '''
+    Expand directories to the images they contain (not recursive), sorted like noteshrink sorts (IMG_10 after
+    IMG_9). Files are kept in the given order.
+    :param paths: list of files and directories
+    :return: list of filenames
+    '''
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                     if name.lower().endswith(IMAGE_EXTENSIONS)]
+            filenames.extend(get_filenames(default_options(filenames=found, sort_numerically=True)))
+        elif os.path.isfile(path):
+            filenames.append(path)
+        else:
+            raise IOError('no such file or directory: {0}'.format(path))
+    return filenames
+
+
+def batch_main(argv=None):
+    '''
+    Entry point of the batch mode. Settings are applied in the order: defaults of the GUI, --options file,
+    command line flags.
+    :param argv: arguments without the program name (and without "--batch"), None for sys.argv[1:]
+    :return: exit code (0 on success, 1 on error)
+    '''
+    args = get_batch_parser().parse_args(argv)
+    try:
+        options = default_options()
+        if args.options_file is not None:
+            with io.open(args.options_file, encoding='utf-8') as f:
+                settings = json.load(f)
+            if not isinstance(settings, dict):
+                raise ValueError('{0} does not contain a JSON object'.format(args.options_file))
+            settings.pop('filenames', None)   # the pages are given on the command line
+            options.__dict__.update(settings)
+        for name in ('basename', 'num_colors', 'sample_fraction', 'value_threshold', 'sat_threshold', 'white_bg',
+                     'saturate', 'kmeans_method', 'sort_numerically', 'global_palette'):
+            if getattr(args, name) is not None:
+                setattr(options, name, getattr(args, name))
+        options.quiet = True   # stdout is reserved for the JSON summary
+
+        filenames = collect_inputs(args.inputs)
+        if options.sort_numerically:
+            filenames = get_filenames(default_options(filenames=filenames, sort_numerically=True))
+        if not filenames:
+            raise IOError('no images found')
+        options_list = []
+        for filename in filenames:
+            page_options = deepcopy(options)
+            page_options.filenames = [filename]
+            options_list.append(page_options)
+
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        disk_cache = DiskCache(args.cache_dir) if args.use_cache else None
+
+        report = RunReport(args.workers)   # collects the events, also without --report (for "stages")
+        Instrumentation.add_listener(report)
+        try:
+            summary = write_outputs(options_list, args.output_dir, args.create_images, args.create_single_pdf,
+                                    args.create_merged_pdf, options.global_palette, args.workers, disk_cache)
+        finally:
+            Instrumentation.remove_listener(report)
+        report.finish(dict(summary))
+        summary['stages'] = Instrumentation.summarize(report.events)
+        if args.report is not None:
+            report.write_json(args.report)
+            summary['report'] = args.report
+        if args.report_html is not None:
+            report.write_html(args.report_html)
+            summary['report_html'] = args.report_html
+    except (IOError, OSError, ValueError) as e:
+        print(json.dumps({'error': str(e)}))
+        return 1
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(batch_main())
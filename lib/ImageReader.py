@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Decoding of images at a reduced size. With QImageReader.setScaledSize the JPEG plugin scales in the DCT domain
+(libjpeg scale_denom), so a 24 MP photo is never fully decoded just to make a preview or a thumbnail.
+'''
+
+from PyQt4.QtCore import QSize, Qt
+from PyQt4.QtGui import QImage, QImageReader
+
+
+def scaled_size(size, max_width=-1, max_height=-1):
+    '''
+    The size of an image which fits into max_width x max_height (keeping the aspect ratio). Images are never
+    enlarged.
+    :param size: QSize of the original image
+    :param max_width: maximum width, -1 for no limit
+    :param max_height: maximum height, -1 for no limit
+    :return: QSize
+    '''
+    bound = QSize(max_width if max_width > 0 else size.width(),
+                  max_height if max_height > 0 else size.height())
+    target = QSize(size)
+    if target.width() > bound.width() or target.height() > bound.height():
+        target.scale(bound, Qt.KeepAspectRatio)
+    return QSize(max(1, target.width()), max(1, target.height()))
+
+
+def image_size(filename):
+    '''
+    Size of an image from its header, without decoding it.
+    :param filename: path to the image
+    :return: QSize or None if the plugin does not report the size
+    '''
+    size = QImageReader(filename).size()
+    return size if size.isValid() else None
+
+
+def read_image(filename, max_width=-1, max_height=-1):
+    '''
+    Read an image, already decoded at the reduced size if a limit is given.
+    :param filename: path to the image
+    :param max_width: maximum width, -1 for no limit
+    :param max_height: maximum height, -1 for no limit
+    :return: QImage (null if the file could not be read)
+    '''
+    reader = QImageReader(filename)
+    size = reader.size()
+    if size.isValid() and (max_width > 0 or max_height > 0):
+        target = scaled_size(size, max_width, max_height)
+        if target != size:
+            reader.setScaledSize(target)
+    image = reader.read()
+    if image.isNull() and (max_width > 0 or max_height > 0):
+        # some plugins do not report their size or fail with a scaled size
+        image = QImage(filename)
+        if not image.isNull():
+            image = image.scaled(scaled_size(image.size(), max_width, max_height), Qt.IgnoreAspectRatio,
+                                 Qt.SmoothTransformation)
+    return image
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Timers and counters for the stages of the noteshrink pipeline (load, sample, bg_color, fg_mask, kmeans,
+apply_palette, save, pdf, ...). Every finished stage is an Event, handed to the registered listeners:
+
+    Instrumentation.add_listener(lambda event: logger.debug(Instrumentation.format_event(event)))
+
+    with Instrumentation.timer('load', pixels=0) as counters:
+        ...
+        counters['pixels'] = width * height
+
+Stages may be nested (e.g. fg_mask is part of apply_palette). Events of a worker process are collected with
+capture() and sent back with the result, the receiving process hands them to its listeners with dispatch().
+Listeners are called in the thread which finished the stage.
+'''
+
+import os
+import sys
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:   # windows, the peak RSS is not known
+    resource = None
+
+# stage: name of the stage, seconds: wall time, page: input filename (None if unknown), counters: dict name > number,
+# start: time.time() at the beginning, pid: process which did the work
+Event = namedtuple('Event', ['stage', 'seconds', 'page', 'counters', 'start', 'pid'])
+
+_listeners = []
+_local = threading.local()    # per thread: captures (list of event lists), page (current input filename)
+
+
+def add_listener(callback):
+    '''
+    :param callback: callable(event), called for every event of this process (and dispatched worker events)
+    '''
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def dispatch(events):
+    '''
+    Hand events to the listeners, e.g. the events a worker process returned with its result.
+    '''
+    for event in events:
+        for callback in list(_listeners):
+            callback(event)
+
+
+def emit(event):
+    '''
+    Collect the event in the innermost capture() of this thread, or dispatch it if nothing is captured.
+    '''
+    captures = getattr(_local, 'captures', None)
+    if captures:
+        captures[-1].append(event)
+    else:
+        dispatch((event,))
+
+
+def current_page():
+    return getattr(_local, 'page', None)
+
+
+def set_page(filename):
+    '''
+    Events of this thread without an explicit page belong to the page filename from now on (None to unset).
+    :return: the previous page
+    '''
+    previous = current_page()
+    _local.page = filename
+    return previous
+
+
+@contextmanager
+def for_page(filename):
+    '''
+    Events without an explicit page emitted in this block belong to the page filename.
+    '''
+    previous = set_page(filename)
+    try:
+        yield
+    finally:
+        set_page(previous)
+
+
+def bind_page(function, filename):
+    '''
+    :return: function, which runs in for_page(filename) (e.g. for a job of a thread pool)
+    '''
+    def bound(*args, **kwargs):
+        with for_page(filename):
+            return function(*args, **kwargs)
+    return bound
+
+
+@contextmanager
+def capture():
+    '''
+    Collect the events of this thread in a list instead of dispatching them (used in worker processes).
+    :return: yields the list, it is complete after the block
+    '''
+    if getattr(_local, 'captures', None) is None:
+        _local.captures = []
+    events = []
+    _local.captures.append(events)
+    try:
+        yield events
+    finally:
+        _local.captures.pop()
+
+
+@contextmanager
+def timer(stage, page=None, **counters):
+    '''
+    Time the block and emit an event afterwards (also if the block raises).
+    :param counters: initial counters, the yielded dict can be updated in the block
+    '''
+    start = time.time()
+    try:
+        yield counters
+    finally:
+        emit(Event(stage, time.time() - start, page if page is not None else current_page(), counters, start,
+                   os.getpid()))
+
+
+def record(stage, seconds=0.0, page=None, **counters):
+    '''
+    Emit an event for a stage which was timed elsewhere (or only has counters).
+    '''
+    emit(Event(stage, seconds, page if page is not None else current_page(), counters, time.time() - seconds,
+               os.getpid()))
+
+
+def max_rss():
+    '''
+    :return: peak resident set size of this process since its start in bytes, None without the resource module
+    '''
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024   # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def current_rss():
+    '''
+    :return: resident set size of this process in bytes, None without /proc (linux only)
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def summarize(events):
+    '''
+    :return: OrderedDict stage > {'count': number of events, 'seconds': total time, <counter>: total of the counter}
+             (counters named peak_..., e.g. peak_rss, are the largest value instead of the total)
+    '''
+    summary = OrderedDict()
+    for event in events:
+        entry = summary.setdefault(event.stage, {'count': 0, 'seconds': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += event.seconds
+        for name, value in event.counters.items():
+            if name.startswith('peak_'):
+                entry[name] = max(entry.get(name, 0), value)
+            else:
+                entry[name] = entry.get(name, 0) + value
+    return summary
+
+
+def format_summary(summary):
+    '''
+    :param summary: result of summarize()
+    :return: text table, one line per stage (in the order of the first event)
+    '''
+    lines = ['{0:<14} {1:>6} {2:>9}  {3}'.format('stage', 'count', 'seconds', 'counters')]
+    for stage in summary:
+        entry = summary[stage]
+        counters = ' '.join('{0}={1}'.format(name, entry[name]) for name in sorted(entry)
+                            if name not in ('count', 'seconds'))
+        lines.append('{0:<14} {1:>6} {2:>9.3f}  {3}'.format(stage, entry['count'], entry['seconds'], counters))
+    return '\n'.join(lines)
+
+
+def format_event(event):
+    '''
+    :return: one line like "apply_palette 0.213 s pixels=8415000 (page_1.png)"
+    '''
+    text = '{0} {1:.3f} s'.format(event.stage, event.seconds)
+    if event.counters:
+        text += ' ' + ' '.join('{0}={1}'.format(name, event.counters[name]) for name in sorted(event.counters))
+    if event.page is not None:
+        text += u' ({0})'.format(os.path.basename(event.page))
+    return text
+
+
+class EventCollector(object):
+
+    """
+    Listener which keeps all events (thread-safe), e.g. for a summary at the end of a run.
+
+        collector = EventCollector()
+        Instrumentation.add_listener(collector)
+        ...
+        Instrumentation.remove_listener(collector)
+        print(Instrumentation.summarize(collector.events))
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
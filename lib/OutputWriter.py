@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Writing of the outputs (images, single PDFs, merged PDF) of a list of pages, shared by the GUI (MainWindow
+.generateOutput) and the headless batch mode (lib/BatchMode.py). Nothing of the GUI is needed here.
+The GUI imports this module at startup (default_options), the processing core is only imported by write_outputs.
+'''
+
+import logging
+import os
+import time
+from argparse import Namespace
+
+import lib.Instrumentation as Instrumentation
+
+logger = logging.getLogger('noteshrinker_qt')
+
+MERGED_PDF_NAME = "merged.pdf"
+
+
+def default_options(**kwargs):
+    '''
+    Initial "empty" options, representing the default values of noteshrink (without filename!)
+    :param kwargs: values which replace the defaults
+    :return: Namespace-Obj (argparse)
+    '''
+    options = Namespace(basename='_optimized', filenames=[], global_palette=False, kmeans_method='full',
+                        kmeans_tol=None, num_colors=8, pdf_cmd=None, pdfname='output.pdf',
+                        postprocess_cmd=None, postprocess_ext='_post.png', quiet=False, sample_fraction=0.05,
+                        sample_height=0, sample_method='random', sample_seed=0, sat_threshold=0.2, saturate=True,
+                        sort_numerically=True, value_threshold=0.25, white_bg=False)
+    options.__dict__.update(kwargs)
+    return options
+
+
+def output_paths(options, output_dir):
+    '''
+    Filenames of the outputs of a page: <name of the input><basename>.<ext of the input> and .pdf
+    :param options: Namespace-Object of the page
+    :param output_dir: target directory
+    :return: tuple (path of the image, path of the single PDF)
+    '''
+    name, ext = os.path.splitext(os.path.basename(options.filenames[0]))
+    if ext.lower() == ".gif":   # QImage does not support write to GIF
+        ext = ".jpg"            #TODO: Gifs have soft red background when converted to jpg or png ??
+    return (os.path.join(output_dir, u"{0}{1}{2}".format(name, options.basename, ext)),
+            os.path.join(output_dir, u"{0}{1}.pdf".format(name, options.basename)))
+
+
+def write_outputs(options_list, output_dir, create_images=True, create_single_pdf=False, create_merged_pdf=False,
+                  global_palette=False, workers=None, disk_cache=None, progress=None):
+    '''
+    Create the requested outputs for all given pages. Every distinct page (same file and same relevant options)
+    is computed only once (by the BatchEngine) and feeds the image, the single PDF and the merged PDF.
+    :param options_list: list of Namespace-Objects (one per page, in the order of the output)
+    :param output_dir: target directory (must exist)
+    :param global_palette: True to use one palette (from the samples of all pages) for every page
+    :param workers: number of worker processes, None for one per cpu core
+    :param disk_cache: DiskCache for the palettes (the labels go to its labels_cache), None to compute everything
+    :param progress: callable(done, total), called after every computed page
+    :return: dict, summary of the run (JSON serializable)
+    '''
+    from lib.noteshrink import labels_to_qimage, finalize_palette, get_global_palette, write_png
+    from lib.BatchEngine import BatchEngine
+    from lib.RenderCache import RenderCache, render_key
+    from lib.PdfWriter import PdfWriter, A4
+
+    start = time.time()
+    keys = [render_key(options) for options in options_list]
+    first_index = {}          # key > index of the first item using it (these are computed)
+    last_index = {}           # key > index of the last item using it (afterwards the result can be dropped)
+    for i, key in enumerate(keys):
+        first_index.setdefault(key, i)
+        last_index[key] = i
+    to_compute = sorted(first_index.values())
+
+    palette = None
+    if global_palette and len(to_compute) > 1:
+        # the palette of the first page's settings, cached on disk for the next run with the same pages
+        filenames = [options_list[i].filenames[0] for i in to_compute]
+        _, palette = get_global_palette(filenames, options_list[0], workers, disk_cache)
+
+    engine = BatchEngine(workers=workers, cache_dir=disk_cache.directory if disk_cache is not None else None)
+    results = engine.imap([options_list[i] for i in to_compute], -1, progress, palette)
+    cache = RenderCache()
+
+    summary = {'pages': len(options_list), 'computed': len(to_compute), 'outputs': [], 'merged_pdf': None,
+               'bytes_written': 0}
+
+    merged_pdf = None
+    if create_merged_pdf:
+        summary['merged_pdf'] = os.path.join(output_dir, MERGED_PDF_NAME)
+        # the indexed pages are embedded as they are, one page after another (no rendering through QPrinter)
+        merged_pdf = PdfWriter(summary['merged_pdf'])
+
+    try:
+        for i, options in enumerate(options_list):
+            # results arrive in the order of to_compute, so the next one is the missing one
+            while keys[i] not in cache:
+                n, labels, palette = next(results)
+                cache.put(keys[to_compute[n]], labels, palette)
+            labels, palette = cache.get(keys[i])
+            if last_index[keys[i]] == i:
+                cache.discard(keys[i])
+            final_palette = finalize_palette(palette, options)
+            Instrumentation.set_page(options.filenames[0])
+
+            path_to_save, path_to_save_pdf = output_paths(options, output_dir)
+            output = {'input': options.filenames[0], 'image': None, 'pdf': None}
+            logger.info(u"Save file {0} to {1}".format(options.filenames[0], path_to_save))
+
+            if create_images:
+                if path_to_save.lower().endswith(".png"):
+                    write_png(path_to_save, labels, final_palette)   # packed 1/2/4 bit indexed PNG
+                else:
+                    with Instrumentation.timer('save', pixels=labels.size) as counters:
+                        labels_to_qimage(labels, final_palette).save(path_to_save)
+                        counters['bytes'] = os.path.getsize(path_to_save)
+                output['image'] = path_to_save
+                summary['bytes_written'] += os.path.getsize(path_to_save)
+
+            if create_single_pdf:
+                # label/palette pair as indexed image stream, like the merged PDF (no rasterization)
+                with Instrumentation.timer('pdf', pages=1) as counters:
+                    single_pdf = PdfWriter(path_to_save_pdf)
+                    single_pdf.add_page(labels, final_palette, page_size=A4)
+                    single_pdf.close()
+                    counters['bytes'] = single_pdf.bytes_written
+                output['pdf'] = path_to_save_pdf
+                summary['bytes_written'] += os.path.getsize(path_to_save_pdf)
+
+            if create_merged_pdf:
+                with Instrumentation.timer('pdf', pages=1) as counters:
+                    before = merged_pdf.bytes_written
+                    merged_pdf.add_page(labels, final_palette, page_size=A4)
+                    counters['bytes'] = merged_pdf.bytes_written - before
+
+            summary['outputs'].append(output)
+    finally:
+        Instrumentation.set_page(None)
+        if merged_pdf is not None:
+            merged_pdf.close()
+        results.close()   # stops the worker pool if the run was aborted
+        cache.close()
+
+    if create_merged_pdf:
+        summary['bytes_written'] += os.path.getsize(summary['merged_pdf'])
+    summary['seconds'] = round(time.time() - start, 3)
+    return summary
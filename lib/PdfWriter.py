@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Streaming writer for multi-page PDF documents of palette images. Every page is one image XObject with an /Indexed
+color space, the palette indices are packed into 1, 2, 4 or 8 bits (as few as the palette allows) and Flate
+compressed while the rows arrive. Only the byte offsets of the objects
+are kept until the document is closed, so the memory use does not depend on the number of pages.
+'''
+
+import binascii
+import zlib
+
+import numpy as np
+
+# A4 in points (1/72 inch)
+A4 = (595.28, 841.89)
+
+
+def bit_depth(num_colors):
+    '''
+    :return: the smallest number of bits per pixel (1, 2, 4 or 8) for a palette of num_colors colors
+    '''
+    for bits in (1, 2, 4):
+        if num_colors <= 1 << bits:
+            return bits
+    return 8
+
+
+def pack_labels(labels, bits):
+    '''
+    Pack the palette indices of every row into bytes, the first pixel in the most significant bits. Every row is
+    padded to whole bytes, like PDF and PNG expect it.
+    :param labels: uint8 array of shape (rows, width), all values below 2**bits
+    :param bits: 1, 2, 4 or 8 bits per pixel
+    :return: uint8 array of shape (rows, ceil(width * bits / 8))
+    '''
+    if bits == 8:
+        return labels
+    if bits == 1:
+        return np.packbits(labels, axis=1)   # every nonzero value is a set bit, labels are 0 or 1 here
+    per_byte = 8 // bits
+    rows, width = labels.shape
+    padded = np.zeros((rows, -(-width // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :width] = labels
+    padded = padded.reshape((rows, -1, per_byte))
+    packed = padded[:, :, 0] << (8 - bits)
+    for k in range(1, per_byte):
+        packed |= padded[:, :, k] << (8 - bits * (k + 1))
+    return packed
+
+
+class PdfWriter(object):
+
+    """
+        pdf = PdfWriter('output.pdf')
+        for labels, palette in pages:
+            pdf.begin_page(width, height, palette, dpi=(300, 300))
+            pdf.write_rows(labels)        # uint8 array (rows, width) of palette indices, may be called per strip
+            pdf.end_page()
+        pdf.close()
+    """
+
+    def __init__(self, filename, level=6):
+        '''
+        :param filename: path of the PDF (or a file object opened for binary writing)
+        :param level: zlib compression level of the images
+        '''
+        if hasattr(filename, 'write'):
+            self._file = filename
+            self._own_file = False
+        else:
+            self._file = open(filename, 'wb')
+            self._own_file = True
+        self.level = level
+        self.pages = 0
+        self._offset = 0
+        self._offsets = {}        # object number > byte offset
+        self._page_objects = []   # object numbers of the /Page objects
+        self._next_object = 3     # 1 is the catalog, 2 the page tree (both written by close())
+        self._page = None         # state of the open page
+
+        # the binary comment marks the file as binary for transfer programs
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def begin_page(self, width, height, palette, dpi=None, page_size=None, bits=None):
+        '''
+        Start a new page with a width x height image.
+        :param palette: array like of (r, g, b) colors, at most 256
+        :param dpi: tuple (x, y) resolution of the image, determines the page size (default 300 dpi)
+        :param page_size: tuple (width, height) in points, the image is scaled to fit (keeping the aspect ratio)
+                          and placed in the upper left corner. None for a page of the size of the image.
+        :param bits: bits per pixel of the image stream (1, 2, 4 or 8), None for the smallest one for the palette
+        '''
+        assert self._page is None, 'end_page() has not been called'
+        palette = np.asarray(palette, dtype=np.uint8).reshape((-1, 3))
+        assert 0 < len(palette) <= 256
+        if bits is None:
+            bits = bit_depth(len(palette))
+        assert len(palette) <= 1 << bits
+
+        if dpi is None:
+            dpi = (300, 300)
+        image_size = (width * 72.0 / dpi[0], height * 72.0 / dpi[1])
+        if page_size is None:
+            page_size = image_size
+            scale = 1.0
+        else:
+            scale = min(page_size[0] / image_size[0], page_size[1] / image_size[1])
+        draw_size = (image_size[0] * scale, image_size[1] * scale)
+
+        image, length = self._reserve(), self._reserve()   # the length is only known after the stream
+        palette_hex = binascii.hexlify(palette.tobytes()).decode('ascii')
+        self._begin_object(image)
+        self._write('<< /Type /XObject /Subtype /Image /Width {0} /Height {1} '
+                    '/ColorSpace [/Indexed /DeviceRGB {2} <{3}>] /BitsPerComponent {4} '
+                    '/Filter /FlateDecode /Length {5} 0 R >>\nstream\n'.format(
+                        width, height, len(palette) - 1, palette_hex, bits, length).encode('ascii'))
+
+        self._page = {'width': width, 'height': height, 'bits': bits, 'rows': 0, 'image': image, 'length': length,
+                      'start': self._offset, 'compressor': zlib.compressobj(self.level), 'page_size': page_size,
+                      'draw_size': draw_size}
+
+    def write_rows(self, labels):
+        '''
+        Append rows to the image of the current page.
+        :param labels: uint8 array of shape (rows, width)
+        '''
+        page = self._page
+        labels = np.asarray(labels, dtype=np.uint8)
+        assert labels.ndim == 2 and labels.shape[1] == page['width']
+        assert page['rows'] + labels.shape[0] <= page['height']
+        packed = pack_labels(labels, page['bits'])
+        self._write(page['compressor'].compress(np.ascontiguousarray(packed).tobytes()))
+        page['rows'] += labels.shape[0]
+
+    def end_page(self):
+        '''
+        Finish the current page (all rows must have been written).
+        '''
+        page = self._page
+        assert page['rows'] == page['height'], 'not all rows have been written'
+        self._write(page['compressor'].flush())
+        stream_length = self._offset - page['start']
+        self._write(b'\nendstream\nendobj\n')
+
+        self._begin_object(page['length'])
+        self._write('{0}\nendobj\n'.format(stream_length).encode('ascii'))
+
+        page_width, page_height = page['page_size']
+        draw_width, draw_height = page['draw_size']
+        content = 'q {0:.2f} 0 0 {1:.2f} 0 {2:.2f} cm /Im0 Do Q\n'.format(
+            draw_width, draw_height, page_height - draw_height).encode('ascii')
+        contents = self._reserve()
+        self._begin_object(contents)
+        self._write('<< /Length {0} >>\nstream\n'.format(len(content)).encode('ascii'))
+        self._write(content)
+        self._write(b'endstream\nendobj\n')
+
+        page_object = self._reserve()
+        self._begin_object(page_object)
+        self._write('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0:.2f} {1:.2f}] '
+                    '/Resources << /XObject << /Im0 {2} 0 R >> >> /Contents {3} 0 R >>\nendobj\n'.format(
+                        page_width, page_height, page['image'], contents).encode('ascii'))
+        self._page_objects.append(page_object)
+
+        self._page = None
+        self.pages += 1
+
+    @property
+    def bytes_written(self):
+        '''
+        :return: size of the PDF so far
+        '''
+        return self._offset
+
+    def add_page(self, labels, palette, dpi=None, page_size=None, bits=None):
+        '''
+        Shortcut for begin_page(), write_rows() and end_page() with a complete label array.
+        '''
+        self.begin_page(labels.shape[1], labels.shape[0], palette, dpi, page_size, bits)
+        self.write_rows(labels)
+        self.end_page()
+
+    def close(self):
+        '''
+        Write the page tree and the cross-reference table and close the file.
+        '''
+        assert self._page is None, 'end_page() has not been called'
+        self._begin_object(2)
+        self._write('<< /Type /Pages /Kids [{0}] /Count {1} >>\nendobj\n'.format(
+            ' '.join('{0} 0 R'.format(number) for number in self._page_objects), self.pages).encode('ascii'))
+        self._begin_object(1)
+        self._write(b'<< /Type /Catalog /Pages 2 0 R >>\nendobj\n')
+
+        xref = self._offset
+        size = self._next_object
+        entries = [b'xref\n', '0 {0}\n'.format(size).encode('ascii'), b'0000000000 65535 f \n']
+        for number in range(1, size):
+            entries.append('{0:010d} 00000 n \n'.format(self._offsets[number]).encode('ascii'))
+        self._write(b''.join(entries))
+        self._write('trailer\n<< /Size {0} /Root 1 0 R >>\nstartxref\n{1}\n%%EOF\n'.format(
+            size, xref).encode('ascii'))
+        if self._own_file:
+            self._file.close()
+
+    def _reserve(self):
+        number = self._next_object
+        self._next_object += 1
+        return number
+
+    def _begin_object(self, number):
+        self._offsets[number] = self._offset
+        self._write('{0} 0 obj\n'.format(number).encode('ascii'))
+
+    def _write(self, data):
+        if data:
+            self._file.write(data)
+            self._offset += len(data)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Streaming writer for indexed (palette) PNG images. The rows are compressed and written as they arrive, so a page
+can be labeled and encoded strip by strip without ever holding the complete label array. The palette indices are
+stored with 1, 2, 4 or 8 bits per pixel, as few as the palette allows.
+'''
+
+import struct
+import zlib
+
+import numpy as np
+
+from lib.PdfWriter import bit_depth, pack_labels
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG row filters which are useful for palette images (the others predict from neighbouring values, which has no
+# meaning for palette indices)
+FILTER_NONE, FILTER_UP = 0, 2
+
+# zlib strategies (Z_RLE is missing in older Pythons, the value is fixed by zlib)
+STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, getattr(zlib, 'Z_RLE', 3))
+
+
+def filter_rows(packed, filter_type, previous=None):
+    '''
+    Apply a PNG row filter and prepend the filter type byte to every row.
+    :param packed: uint8 array (rows, bytes per row) of packed palette indices
+    :param filter_type: FILTER_NONE or FILTER_UP
+    :param previous: last row of the previous strip (FILTER_UP), None at the top of the image
+    :return: uint8 array (rows, 1 + bytes per row)
+    '''
+    rows = np.empty((packed.shape[0], packed.shape[1] + 1), dtype=np.uint8)
+    rows[:, 0] = filter_type
+    rows[:, 1:] = packed
+    if filter_type == FILTER_UP:
+        rows[1:, 1:] -= packed[:-1]   # wraps around modulo 256, like PNG expects it
+        if previous is not None:
+            rows[0, 1:] -= previous
+    return rows
+
+
+def choose_encoding(labels, bits, levels=(6, 9), sample_rows=64, samples=4):
+    '''
+    Find the PNG row filter, zlib strategy and level which give the smallest file for a page. A few blocks of rows
+    spread over the page are compressed with every combination, the cheapest level which comes within 1% of the
+    smallest result wins.
+    :param labels: uint8 array (rows, width) of palette indices
+    :param bits: bits per pixel (see lib.PdfWriter.bit_depth)
+    :return: tuple (filter_type, strategy, level)
+    '''
+    height = labels.shape[0]
+    starts = sorted(set(int(start) for start in np.linspace(0, max(0, height - sample_rows), samples)))
+    blocks = [pack_labels(labels[start:start + sample_rows], bits) for start in starts]
+
+    results = []
+    for filter_type in (FILTER_NONE, FILTER_UP):
+        data = b''.join(filter_rows(block, filter_type).tobytes() for block in blocks)
+        for strategy in STRATEGIES:
+            for level in levels:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+                size = len(compressor.compress(data)) + len(compressor.flush())
+                results.append((size, level, filter_type, strategy))
+
+    best = min(size for size, _, _, _ in results)
+    size, level, filter_type, strategy = min(result for result in results if result[0] <= best * 1.01)
+    return filter_type, strategy, level
+
+
+class IndexedPngWriter(object):
+
+    """
+        writer = IndexedPngWriter('page.png', width, height, palette, dpi=(300, 300))
+        for strip in strips:
+            writer.write_rows(strip)      # uint8 array (rows, width) of palette indices
+        writer.close()
+    """
+
+    def __init__(self, filename, width, height, palette, dpi=None, level=6, chunk_size=256 * 1024, bits=None,
+                 strategy=zlib.Z_DEFAULT_STRATEGY, filter_type=FILTER_NONE):
+        '''
+        :param filename: path of the PNG (or a file object opened for binary writing)
+        :param width: width of the image in pixels
+        :param height: number of rows which will be written
+        :param palette: array like of (r, g, b) colors, at most 256
+        :param dpi: tuple (x, y) stored in the pHYs chunk, None to omit it
+        :param level: zlib compression level
+        :param chunk_size: compressed bytes are collected up to this size before an IDAT chunk is written
+        :param bits: bits per pixel (1, 2, 4 or 8), None for the smallest one for the palette
+        :param strategy: zlib strategy (see STRATEGIES)
+        :param filter_type: PNG row filter, FILTER_NONE or FILTER_UP (see choose_encoding)
+        '''
+        palette = np.asarray(palette, dtype=np.uint8).reshape((-1, 3))
+        assert 0 < len(palette) <= 256
+        if bits is None:
+            bits = bit_depth(len(palette))
+        assert len(palette) <= 1 << bits
+
+        if hasattr(filename, 'write'):
+            self._file = filename
+            self._own_file = False
+        else:
+            self._file = open(filename, 'wb')
+            self._own_file = True
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.bytes_written = 0    # size of the PNG so far
+        self.chunk_size = chunk_size
+        self.bits = bits
+        self.filter_type = filter_type
+        self._previous = None     # last packed row, FILTER_UP continues with it in the next strip
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+        self._pending = []
+        self._pending_size = 0
+
+        self._file.write(PNG_SIGNATURE)
+        self.bytes_written += len(PNG_SIGNATURE)
+        # width, height, bit depth, color type 3 (indexed), compression, filter, interlace
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bits, 3, 0, 0, 0))
+        self._chunk(b'PLTE', palette.tobytes())
+        if dpi is not None:
+            ppm = [int(round(value / 0.0254)) for value in dpi]   # pixels per meter
+            self._chunk(b'pHYs', struct.pack('>IIB', ppm[0], ppm[1], 1))
+
+    def write_rows(self, labels):
+        '''
+        Append rows to the image.
+        :param labels: uint8 array of shape (rows, width)
+        '''
+        labels = np.asarray(labels, dtype=np.uint8)
+        assert labels.ndim == 2 and labels.shape[1] == self.width
+        assert self.rows_written + labels.shape[0] <= self.height
+
+        if labels.shape[0] == 0:
+            return
+        packed = pack_labels(labels, self.bits)
+        rows = filter_rows(packed, self.filter_type, self._previous)
+        self._previous = packed[-1].copy()
+        self._add(self._compressor.compress(rows.tobytes()))
+        self.rows_written += labels.shape[0]
+
+    def close(self):
+        '''
+        Finish the image (all rows must have been written) and close the file.
+        '''
+        assert self.rows_written == self.height, 'not all rows have been written'
+        self._add(self._compressor.flush())
+        self._flush()
+        self._chunk(b'IEND', b'')
+        if self._own_file:
+            self._file.close()
+
+    def _add(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+        self.bytes_written += len(data) + 12   # length, type and crc
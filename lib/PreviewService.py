@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+import traceback
+import types
+from PyQt4.QtCore import QObject, QThread, pyqtSignal
+
+logger = logging.getLogger('noteshrinker_qt')
+
+# status of a finished worker
+DONE, FAILED, CANCELLED = range(3)
+
+
+class PreviewCancelled(Exception):
+    '''
+    Raised by a compute function (generator) which stops early because its request has been superseded.
+    '''
+
+
+class _PreviewWorker(QThread):
+
+    """
+    Runs one preview computation. The result is transported back with a signal, so it is received in the thread
+    of the PreviewService (the GUI thread).
+    If the function is a generator, every yielded value is sent as a partial result and the last one is the final
+    result. The yield returns True if the worker has been cancelled, the generator can raise PreviewCancelled then
+    to skip its remaining steps. A generator which simply finishes (e.g. after its final yield) delivers its
+    final result, it is never discarded.
+    """
+
+    sig_partial = pyqtSignal(object, int, object)      # page_id, serial, result
+    sig_done = pyqtSignal(object, int, object, int)    # page_id, serial, result, status (DONE, FAILED, CANCELLED)
+
+    def __init__(self, page_id, serial, function, args):
+        QThread.__init__(self)
+        self.page_id = page_id
+        self.serial = serial
+        self.function = function
+        self.args = args
+        self.cancelled = False   # set from the GUI thread, sent into a generator between its steps
+
+    def run(self):
+        try:
+            result = self.function(*self.args)
+            if isinstance(result, types.GeneratorType):
+                steps = result
+                result = None
+                end = object()
+                step = next(steps, end)
+                while step is not end:
+                    result = step
+                    self.sig_partial.emit(self.page_id, self.serial, result)
+                    try:
+                        step = steps.send(self.cancelled)
+                    except StopIteration:
+                        step = end
+            status = DONE
+        except PreviewCancelled:
+            self.sig_done.emit(self.page_id, self.serial, None, CANCELLED)
+            return
+        except Exception:
+            result = "".join(traceback.format_exception(*sys.exc_info()))
+            status = FAILED
+        self.sig_done.emit(self.page_id, self.serial, result, status)
+
+
+class PreviewService(QObject):
+
+    """
+    Asynchronous preview computation without blocking (or spinning) the GUI thread.
+
+        service = PreviewService(compute_function)
+        service.sig_previewReady.connect(on_ready)     # on_ready(page_id, result, stale)
+        service.sig_previewPartial.connect(on_partial) # on_partial(page_id, result), only for generators
+        service.request(page_id, *args)                # returns immediately
+
+    - at most one computation per page is running at the same time
+    - a request for a page which is currently computed is queued, a newer request replaces the queued one
+    - a request for a page drops everything that is queued for other pages (the selection has changed)
+    - results of superseded requests are still delivered, but flagged as "stale", the receiver can store them, but
+      should not display them.
+    - a compute function which is a generator delivers intermediate results (e.g. a rough preview first), they are
+      only sent for the newest request. A superseded generator gets True from its yield and can stop before its
+      next step (raise PreviewCancelled), its final result is delivered as stale like any other.
+    """
+
+    sig_previewReady = pyqtSignal(object, object, bool)   # page_id, result of the compute function, stale
+    sig_previewFailed = pyqtSignal(object)                # page_id
+    sig_previewCancelled = pyqtSignal(object)             # page_id, a superseded generator has been stopped
+    sig_previewPartial = pyqtSignal(object, object)       # page_id, intermediate result of the compute function
+
+    def __init__(self, compute, parent=None):
+        '''
+        :param compute: callable(*args) executed in a worker thread for every request
+        :param parent: QObject
+        '''
+        QObject.__init__(self, parent)
+        self.compute = compute
+        self._serial = 0
+        self._newest = {}     # page_id > serial of the newest request (results of older ones are stale)
+        self._running = {}    # page_id > _PreviewWorker
+        self._pending = {}    # page_id > (serial, args)
+
+    def request(self, page_id, *args):
+        '''
+        Request a new preview for page_id, the compute function will be called with *args.
+        :return: serial number of the request
+        '''
+        self._serial += 1
+        serial = self._serial
+        self.cancel(exclude=page_id)
+        self._newest[page_id] = serial
+        if page_id in self._running:
+            self._running[page_id].cancelled = True
+            self._pending[page_id] = (serial, args)     # supersedes an older queued request
+        else:
+            self._start(page_id, serial, args)
+        return serial
+
+    def cancel(self, exclude=None):
+        '''
+        Drop all queued requests and mark running ones as stale (a running computation can not be interrupted, its
+        result is delivered with stale=True. Generators can stop before their next step).
+        :param exclude: page_id which is not affected
+        '''
+        for page_id in list(self._pending):
+            if page_id != exclude:
+                del self._pending[page_id]
+        for page_id in list(self._newest):
+            if page_id != exclude:
+                del self._newest[page_id]
+        for page_id, worker in self._running.items():
+            if page_id != exclude:
+                worker.cancelled = True
+
+    def wait(self):
+        '''
+        Block until the running computations have returned (their results are delivered afterwards as usual). Call
+        cancel() first, cancelled generators can stop before their next step.
+        '''
+        for worker in list(self._running.values()):
+            worker.wait()
+
+    def isBusy(self, page_id=None):
+        '''
+        :return: True if anything (or the given page) is computed or queued
+        '''
+        if page_id is None:
+            return bool(self._running or self._pending)
+        return page_id in self._running or page_id in self._pending
+
+    def _start(self, page_id, serial, args):
+        worker = _PreviewWorker(page_id, serial, self.compute, args)
+        worker.sig_partial.connect(self._on_partial)
+        worker.sig_done.connect(self._on_done)
+        self._running[page_id] = worker
+        worker.start()
+
+    def _on_partial(self, page_id, serial, result):
+        if self._newest.get(page_id) == serial:
+            self.sig_previewPartial.emit(page_id, result)
+
+    def _on_done(self, page_id, serial, result, status):
+        worker = self._running.pop(page_id, None)
+        if worker is not None:
+            worker.wait()   # run() has already returned, this only joins the thread
+            worker.deleteLater()
+
+        if page_id in self._pending:
+            next_serial, args = self._pending.pop(page_id)
+            self._start(page_id, next_serial, args)
+
+        if status == CANCELLED:
+            self.sig_previewCancelled.emit(page_id)
+            return
+
+        if status == FAILED:
+            logger.error("Preview computation for {0} failed:\n{1}".format(repr(page_id), result))
+            if self._newest.get(page_id) == serial:
+                del self._newest[page_id]
+            self.sig_previewFailed.emit(page_id)
+            return
+
+        stale = self._newest.get(page_id) != serial
+        if not stale:
+            del self._newest[page_id]
+        self.sig_previewReady.emit(page_id, result, stale)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Caches for computed label/palette pairs, so that the expensive part of noteshrink (load, k-means, labeling) is only
+done once per page.
+'''
+
+import errno
+import hashlib
+import json
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+# numpy is imported in the methods which need it: the GUI creates a DiskCache at startup, before anything is
+# computed (see the import budget in README.md)
+
+# options which change the result of lib.noteshrink.render_page. (saturate and white_bg are applied when the
+# output is written, see lib.noteshrink.finalize_palette)
+RENDER_OPTIONS = ('num_colors', 'sample_fraction', 'sat_threshold', 'value_threshold', 'kmeans_method',
+                  'kmeans_tol', 'sample_method', 'sample_seed', 'sample_height')
+
+_digests = {}                     # file_identity > md5 of the content
+_digests_lock = threading.Lock()
+
+# full resolution labels are large and every output run writes new ones, they have their own size budget in a
+# subdirectory of the cache directory, so they do not push the palettes and thumbnails out of the cache
+LABELS_SUBDIR = 'labels'
+LABELS_MAX_BYTES = 256 * 1024 * 1024
+
+_labels_caches = {}               # cache directory > DiskCache of the labels, see labels_cache()
+_labels_caches_lock = threading.Lock()
+
+
+def file_identity(filename):
+    '''
+    Cheap identity of a file, changes whenever the file is replaced or modified.
+    :param filename: path to the file
+    :return: tuple (absolute path, mtime, size)
+    '''
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_mtime, stat.st_size
+
+
+def file_digest(filename):
+    '''
+    md5 hash of the file content. The hash is remembered as long as the file identity (path, mtime, size) does not
+    change, so every file is only read once.
+    :param filename: path to the file
+    :return: str (hexdigest)
+    '''
+    identity = file_identity(filename)
+    with _digests_lock:
+        digest = _digests.get(identity)
+    if digest is None:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+        digest = md5.hexdigest()
+        with _digests_lock:
+            _digests[identity] = digest
+    return digest
+
+
+def palette_key(options):
+    '''
+    Build the PaletteCache key for the first filename of "options". The palette does not depend on the resolution,
+    so the height is not part of the key.
+    :param options: Namespace-Object
+    :return: hashable tuple
+    '''
+    return file_digest(options.filenames[0]), render_options(options)
+
+
+def render_key(options, height=-1):
+    '''
+    Build the cache key for rendering the first filename of "options" at the given height.
+    :param options: Namespace-Object
+    :param height: maximum height of the result, -1 for full size
+    :return: hashable tuple
+    '''
+    return file_identity(options.filenames[0]), height, render_options(options)
+
+
+def render_options(options):
+    '''
+    :return: tuple with the values of RENDER_OPTIONS (None for options which are not set)
+    '''
+    return tuple(getattr(options, name, None) for name in RENDER_OPTIONS)
+
+
+def disk_key(filename, options, kind, height=-1):
+    '''
+    Content addressed key for the DiskCache: the hash of the file content, its mtime, the relevant options, the kind
+    of the cached data (e.g. 'palette', 'labels', 'thumbnail') and the height.
+    :return: str (hexdigest)
+    '''
+    description = [file_digest(filename), os.stat(filename).st_mtime, list(render_options(options)), kind, height]
+    return hashlib.md5(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def global_palette_key(filenames, options):
+    '''
+    DiskCache key of a palette shared by all the given files (see lib.noteshrink.get_global_palette), it changes
+    with the content and the order of the files.
+    :return: str (hexdigest)
+    '''
+    description = ['global_palette', [file_digest(filename) for filename in filenames],
+                   list(render_options(options))]
+    return hashlib.md5(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def default_cache_dir():
+    '''
+    :return: the per-user cache directory of noteshrinker-qt
+    '''
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'noteshrinker-qt')
+
+
+def labels_cache(directory=None):
+    '''
+    The DiskCache for the labels of whole pages (kind "labels" of disk_key) in the cache directory "directory".
+    There is one instance per process and directory, the size of the directory is only determined once.
+    :param directory: cache directory, default: default_cache_dir()
+    :return: DiskCache in the subdirectory LABELS_SUBDIR, capped at LABELS_MAX_BYTES
+    '''
+    directory = directory or default_cache_dir()
+    with _labels_caches_lock:
+        cache = _labels_caches.get(directory)
+        if cache is None:
+            cache = DiskCache(os.path.join(directory, LABELS_SUBDIR), LABELS_MAX_BYTES)
+            _labels_caches[directory] = cache
+    return cache
+
+
+class RenderCache(object):
+
+    """
+    Stores label/palette pairs for the duration of an output run. Label arrays are kept in memory until
+    "max_memory" bytes are used, larger arrays (and everything above the budget) are spilled as .npy files into a
+    temporary directory and memory-mapped again when requested.
+
+        cache = RenderCache()
+        try:
+            cache.put(key, labels, palette)
+            labels, palette = cache.get(key)
+        finally:
+            cache.close()
+    """
+
+    def __init__(self, max_memory=256 * 1024 * 1024, spill_threshold=64 * 1024 * 1024, tmpdir=None):
+        '''
+        :param max_memory: number of bytes the label arrays may use in memory
+        :param spill_threshold: label arrays of this size (bytes) are always written to disk
+        :param tmpdir: parent directory for spilled arrays, None for the system default
+        '''
+        self.max_memory = max_memory
+        self.spill_threshold = spill_threshold
+        self.tmpdir = tmpdir
+        self._spill_dir = None
+        self._spill_count = 0
+        self._entries = {}    # key > [labels or path to .npy, palette]
+        self._memory = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, labels, palette):
+        '''
+        Store a result. An existing entry with the same key is replaced.
+        '''
+        self.discard(key)
+        if labels.nbytes >= self.spill_threshold or self._memory + labels.nbytes > self.max_memory:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix='noteshrinker-', dir=self.tmpdir)
+            self._spill_count += 1
+            path = os.path.join(self._spill_dir, '{0}.npy'.format(self._spill_count))
+            import numpy as np
+            np.save(path, labels)
+            self._entries[key] = [path, palette]
+        else:
+            self._entries[key] = [labels, palette]
+            self._memory += labels.nbytes
+
+    def get(self, key):
+        '''
+        :return: tuple (labels, palette) or None if the key is unknown. Spilled labels are returned as a read-only
+                 memory map.
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        labels, palette = entry
+        import numpy as np
+        if not isinstance(labels, np.ndarray):
+            labels = np.load(labels, mmap_mode='r')
+        return labels, palette
+
+    def discard(self, key):
+        '''
+        Forget a result (and release its memory or delete the spilled file).
+        '''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        labels = entry[0]
+        import numpy as np
+        if isinstance(labels, np.ndarray):
+            self._memory -= labels.nbytes
+        else:
+            try:
+                os.unlink(labels)
+            except OSError:
+                pass   # still mapped (windows), removed with the spill directory
+
+    def close(self):
+        '''
+        Drop all entries and remove the spill directory.
+        '''
+        self._entries = {}
+        self._memory = 0
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+
+class PaletteCache(object):
+
+    """
+    Thread-safe, size limited (least recently used entries are dropped) store for palettes (bg color + centers),
+    separate from the rendered images. With a cached palette a page at another resolution only needs the labeling
+    step (lib.noteshrink.render_page(..., palette=palette)).
+    """
+
+    def __init__(self, max_entries=256, disk=None):
+        '''
+        :param max_entries: number of palettes kept in memory
+        :param disk: optional DiskCache, palettes are additionally stored there and survive a restart
+        '''
+        self.max_entries = max_entries
+        self.disk = disk
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        :return: palette or None
+        '''
+        with self._lock:
+            palette = self._entries.pop(key, None)
+            if palette is not None:
+                self._entries[key] = palette   # most recently used
+                return palette
+        if self.disk is not None:
+            arrays = self.disk.get_arrays(self._disk_key(key))
+            if arrays is not None:
+                palette = arrays['palette']
+                self.put(key, palette, store=False)
+        return palette
+
+    def put(self, key, palette, store=True):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = palette
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if store and self.disk is not None:
+            self.disk.put_arrays(self._disk_key(key), palette=palette)
+
+    def _disk_key(self, key):
+        return hashlib.md5(json.dumps(['palette', key[0], list(key[1])]).encode('utf-8')).hexdigest()
+
+
+class DiskCache(object):
+
+    """
+    Persistent, content addressed cache in a directory (default: default_cache_dir()). Entries are numpy arrays
+    (.npz) or raw bytes (e.g. an encoded thumbnail), the keys are built with disk_key(). The total size is capped,
+    the least recently used entries (file mtime, updated on every hit) are deleted first.
+    Several processes may use the same directory, files are written under a temporary name and renamed.
+    """
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self._size = None    # total size of the entries, determined on the first write
+        self._lock = threading.Lock()
+
+    def get_arrays(self, key):
+        '''
+        :return: dict name > array or None
+        '''
+        path = self._hit(key, '.npz')
+        if path is None:
+            return None
+        import numpy as np
+        try:
+            with np.load(path) as data:
+                return dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            return None   # broken (or just evicted) entry
+
+    def put_arrays(self, key, **arrays):
+        import numpy as np
+        self._write(key, '.npz', lambda f: np.savez_compressed(f, **arrays))
+
+    def get_bytes(self, key):
+        '''
+        :return: bytes or None
+        '''
+        path = self._hit(key, '.bin')
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put_bytes(self, key, data):
+        self._write(key, '.bin', lambda f: f.write(data))
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def _hit(self, key, ext):
+        path = self._path(key, ext)
+        try:
+            os.utime(path, None)   # most recently used
+        except OSError:
+            return None
+        return path
+
+    def _write(self, key, ext, writer):
+        path = self._path(key, ext)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+        tmp = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as f:
+                writer(f)
+            replaced = 0
+            if os.path.exists(path):
+                replaced = os.path.getsize(path)
+                os.unlink(path)   # os.rename does not replace on windows
+            os.rename(tmp, path)
+            size = os.path.getsize(path) - replaced
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return   # a cache which can not be written is no reason to fail
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[2] for entry in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        '''
+        :return: list of (mtime, path, size) of all entries
+        '''
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [name for name in dirs if len(name) == 2]   # not the labels_cache() below
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _evict(self):
+        '''
+        Delete the least recently used entries until 90% of max_bytes are reached. (called with self._lock held)
+        '''
+        entries = sorted(self._entries())
+        self._size = sum(entry[2] for entry in entries)
+        for mtime, path, size in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                self._size -= size
+            except OSError:
+                pass
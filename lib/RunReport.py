@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Performance report of one output run (GUI or batch mode), written as JSON and optionally as HTML. It contains per
+page the wall time of every stage (see lib.Instrumentation), the input and output bytes and the compression ratio,
+and for the whole run the peak RSS, the totals and the worker utilization. The JSON files of several runs can be
+compared to track the throughput over time; the slowest pages are listed separately.
+
+Only the events of the thread which created the report are collected (the results of the worker processes are
+dispatched there, too), so previews computed in other threads of the GUI meanwhile are not part of it.
+
+    report = RunReport(workers=4)
+    Instrumentation.add_listener(report)
+    summary = write_outputs(...)
+    Instrumentation.remove_listener(report)
+    report.finish(summary)
+    report.write_json('report.json')
+    report.write_html('report.html')
+'''
+
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from lib.Instrumentation import summarize, max_rss, current_rss
+
+REPORT_VERSION = 2
+SLOWEST_PAGES = 5     # number of pages listed as the slowest ones
+
+
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except (OSError, TypeError):
+        return None
+
+
+def escape(value):
+    '''
+    :return: value as HTML text, "-" for None
+    '''
+    if value is None:
+        return u'-'
+    text = u'{0}'.format(value)
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;').replace(u'"', u'&quot;')
+
+
+def ratio(before, after):
+    '''
+    :return: before / after (how many times smaller the output is), None if unknown
+    '''
+    if not before or not after:
+        return None
+    return round(float(before) / after, 3)
+
+
+class RunReport(object):
+
+    """
+    Listener of lib.Instrumentation which collects the events of one run, see the module docstring.
+    """
+
+    def __init__(self, workers=None):
+        '''
+        :param workers: number of worker processes of the run, None for one per cpu core (like BatchEngine)
+        '''
+        self.workers = workers or multiprocessing.cpu_count()
+        self.started = time.time()
+        self.seconds = None
+        self.events = []
+        self.summary = None
+        self.rss = None
+        self.thread = threading.current_thread().ident   # the thread of the run
+        self._max_rss_before = max_rss()
+        self._rss_measured = current_rss()   # largest RSS measured at an event of the run
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if threading.current_thread().ident != self.thread:
+            return   # e.g. a preview of the GUI
+        rss = current_rss()
+        with self._lock:
+            self.events.append(event)
+            if rss is not None and rss > self._rss_measured:
+                self._rss_measured = rss
+
+    def finish(self, summary=None):
+        '''
+        End the run.
+        :param summary: result of lib.OutputWriter.write_outputs (for the output files), None if not available
+        '''
+        self.seconds = time.time() - self.started
+        self.summary = summary
+        self.rss = self.peak_rss()
+
+    def peak_rss(self):
+        '''
+        Peak resident set size of the run. Every worker process lives for one run only, it reports its own peak with
+        the "render" events. The peak of this process (ru_maxrss) covers the whole session, it is only used if the
+        run has raised it; otherwise the largest RSS measured at the events of the run is used.
+        :return: dict with the peak in bytes of this process ("self") and of the largest worker process ("workers"),
+                 None for unknown values
+        '''
+        peak = max_rss()
+        if peak is None or self._max_rss_before is None or peak <= self._max_rss_before:
+            peak = self._rss_measured
+        pid = os.getpid()
+        workers = [event.counters['peak_rss'] for event in self.events
+                   if event.stage == 'render' and event.pid != pid and event.counters.get('peak_rss')]
+        return {'self': peak, 'workers': max(workers) if workers else None}
+
+    def pages(self):
+        '''
+        :return: list of dicts, one per page in the order of the first event of the page
+        '''
+        pages = []
+        by_name = {}
+        for event in self.events:
+            if event.page is None:
+                continue
+            page = by_name.get(event.page)
+            if page is None:
+                page = {'page': event.page, 'stages': {}, 'pixels': None, 'input_bytes': file_size(event.page),
+                        'output_bytes': 0, 'cached': False}
+                by_name[event.page] = page
+                pages.append(page)
+            page['stages'][event.stage] = round(page['stages'].get(event.stage, 0.0) + event.seconds, 4)
+            if event.stage in ('load', 'render') and event.counters.get('pixels'):
+                page['pixels'] = event.counters['pixels']
+            if event.stage == 'render' and event.counters.get('cached'):
+                page['cached'] = True
+            if event.stage in ('save', 'pdf'):
+                page['output_bytes'] += event.counters.get('bytes', 0)
+
+        for page in pages:
+            # the time spent on the page: the whole job in a worker (render, it contains load...apply_palette)
+            # and the writing of the outputs
+            stages = page['stages']
+            compute = stages.get('render')
+            if compute is None:
+                compute = sum(stages.get(name, 0.0) for name in ('load', 'sample', 'bg_color', 'kmeans',
+                                                                 'apply_palette'))
+            page['seconds'] = round(compute + stages.get('save', 0.0) + stages.get('pdf', 0.0), 4)
+            page['compression_ratio'] = ratio(page['input_bytes'], page['output_bytes'])
+        return pages
+
+    def utilization(self):
+        '''
+        Worker utilization, from the "render" events (one per page job, see lib.BatchEngine).
+        :return: dict with the busy seconds (total and per worker process) and the busy fraction of all workers
+                 during the rendering, None if no page was rendered
+        '''
+        renders = [event for event in self.events if event.stage == 'render']
+        if not renders:
+            return None
+        begin = min(event.start for event in renders)
+        end = max(event.start + event.seconds for event in renders)
+        busy = {}
+        for event in renders:
+            busy[event.pid] = busy.get(event.pid, 0.0) + event.seconds
+        workers = min(self.workers, len(renders))
+        wall = end - begin
+        return {'workers': workers,
+                'processes': len(busy),
+                'wall_seconds': round(wall, 4),
+                'busy_seconds': round(sum(busy.values()), 4),
+                'busy_per_process': sorted(round(seconds, 4) for seconds in busy.values()),
+                'utilization': round(sum(busy.values()) / (workers * wall), 3) if wall > 0 else None}
+
+    def to_dict(self):
+        '''
+        :return: the report as JSON serializable dict
+        '''
+        pages = self.pages()
+        input_bytes = sum(page['input_bytes'] or 0 for page in pages)
+        output_bytes = sum(page['output_bytes'] for page in pages)
+        if self.summary is not None:
+            output_bytes = self.summary.get('bytes_written', output_bytes)   # also counts the PDF trailers
+        seconds = self.seconds if self.seconds is not None else time.time() - self.started
+        pixels = sum(page['pixels'] or 0 for page in pages)
+        return {
+            'version': REPORT_VERSION,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(seconds, 3),
+            'pages': pages,
+            'slowest_pages': [page['page'] for page in sorted(pages, key=lambda page: -page['seconds'])
+                              [:SLOWEST_PAGES]],
+            'totals': {'pages': len(pages),
+                       'input_bytes': input_bytes,
+                       'output_bytes': output_bytes,
+                       'compression_ratio': ratio(input_bytes, output_bytes),
+                       'pixels': pixels,
+                       'pages_per_second': round(len(pages) / seconds, 3) if seconds > 0 else None,
+                       'megapixels_per_second': round(pixels / 1e6 / seconds, 3) if seconds > 0 else None},
+            'stages': summarize(self.events),
+            'workers': self.utilization(),
+            'peak_rss': self.rss or self.peak_rss(),
+            'outputs': self.summary,
+        }
+
+    def write_json(self, filename):
+        data = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(data if not isinstance(data, bytes) else data.decode('utf-8'))
+
+    def write_html(self, filename):
+        '''
+        Write the report as a standalone HTML page (tables of the totals, the stages and the pages).
+        '''
+        report = self.to_dict()
+
+        def table(header, rows):
+            lines = [u'<table>', u'<tr>' + u''.join(u'<th>{0}</th>'.format(escape(name)) for name in header) +
+                     u'</tr>']
+            for row in rows:
+                lines.append(u'<tr>' + u''.join(u'<td>{0}</td>'.format(escape(value)) for value in row) + u'</tr>')
+            lines.append(u'</table>')
+            return u'\n'.join(lines)
+
+        totals = report['totals']
+        workers = report['workers'] or {}
+        rss = report['peak_rss'] or {}
+        overview = [(u'started', report['started']), (u'seconds', report['seconds'])]
+        overview += [(name, totals[name]) for name in sorted(totals)]
+        overview += [(u'workers', workers.get('workers')), (u'worker utilization', workers.get('utilization')),
+                     (u'peak RSS (MB)', round(rss['self'] / 1048576.0, 1) if rss.get('self') else None),
+                     (u'peak RSS of a worker (MB)',
+                      round(rss['workers'] / 1048576.0, 1) if rss.get('workers') else None)]
+
+        stage_names = sorted(set(stage for page in report['pages'] for stage in page['stages']))
+        slowest = set(report['slowest_pages'])
+        page_rows = []
+        for page in report['pages']:
+            name = os.path.basename(page['page']) + (u' *' if page['page'] in slowest else u'')
+            page_rows.append([name, page['seconds']] + [page['stages'].get(stage) for stage in stage_names] +
+                             [page['input_bytes'], page['output_bytes'], page['compression_ratio'],
+                              u'yes' if page['cached'] else u''])
+
+        stage_rows = [(stage, entry['count'], round(entry['seconds'], 3)) for stage, entry in report['stages'].items()]
+
+        html = u'\n'.join([
+            u'<!DOCTYPE html>',
+            u'<html><head><meta charset="utf-8"><title>noteshrinker-qt run {0}</title>'.format(report['started']),
+            u'<style>body {font-family: sans-serif} table {border-collapse: collapse; margin-bottom: 1em} '
+            u'td, th {border: 1px solid #ccc; padding: 2px 6px; text-align: right} '
+            u'td:first-child, th:first-child {text-align: left}</style></head><body>',
+            u'<h1>Run {0}</h1>'.format(escape(report['started'])),
+            table([u'', u'value'], overview),
+            u'<h2>Stages</h2>',
+            table([u'stage', u'count', u'seconds'], stage_rows),
+            u'<h2>Pages</h2><p>* one of the {0} slowest pages, times in seconds</p>'.format(SLOWEST_PAGES),
+            table([u'page', u'seconds'] + stage_names + [u'input bytes', u'output bytes', u'ratio', u'cached'],
+                  page_rows),
+            u'</body></html>', u''])
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(html)
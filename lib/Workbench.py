@@ -1,8 +1,40 @@
 import sys, os
-from argparse import Namespace
 from copy import deepcopy
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
+from lib.RenderCache import DiskCache, disk_key
+from lib.ImageReader import read_image
+from lib.OutputWriter import default_options
+
+THUMBNAIL_ROLE = Qt.UserRole + 1    # data role of the picture item holding the id of its (pending) thumbnail
+
+
+class _ThumbnailEmitter(QObject):
+    # QRunnable is no QObject, the signal is sent by this helper
+    sig_ready = pyqtSignal(int, QImage)   # thumbnail id, thumbnail
+
+
+class _ThumbnailTask(QRunnable):
+
+    """
+    Decodes and scales one image in a thread of the QThreadPool. Only QImage is used here, QPixmap must not be
+    used outside of the GUI thread.
+    """
+
+    def __init__(self, thumbnail_id, file, function):
+        QRunnable.__init__(self)
+        self.thumbnail_id = thumbnail_id
+        self.file = file
+        self.function = function
+        self.emitter = _ThumbnailEmitter()
+
+    def run(self):
+        try:
+            image = self.function(self.file)
+        except Exception:
+            image = QImage()
+        self.emitter.sig_ready.emit(self.thumbnail_id, image)
+
 
 class Workbench_Tablewidget(QTableWidget):
 
@@ -32,16 +64,20 @@ class Workbench_Tablewidget(QTableWidget):
         self.last_drop_row = None
         self.generalOption = self.empty_default_options()
         self.global_active = False
+        self.disk_cache = DiskCache()    # thumbnails are cached across sessions
+        self.thumbnail_pool = QThreadPool(self)   # thumbnails are decoded in the background
+        self.thumbnail_tasks = {}        # thumbnail id > _ThumbnailTask (keeps the python objects alive)
+        self.thumbnail_count = 0         # last used thumbnail id
+        self.thumbnails_requested = 0    # number of thumbnails of the current batch (for the progressbar)
+        self.thumbnails_paused = None    # list of the tasks requested while paused (see pause_thumbnails)
+        self.placeholder = QIcon(":/image.png").pixmap(48, 48)   # shown until the thumbnail is ready
 
     def empty_default_options(self):
         '''
         Initial "empty" options, representing the default values of noteshrink (without filename!)
         :return: Namespace-Obj (argparse)
         '''
-        return Namespace(basename='_optimized', filenames=[], global_palette=False,
-                         num_colors=8, pdf_cmd='convert %i %o', pdfname='output.pdf', postprocess_cmd=None,
-                         postprocess_ext='_post.png', quiet=False, sample_fraction=0.05, sat_threshold=0.2,
-                         saturate=True, sort_numerically=True, value_threshold=0.25, white_bg=False)
+        return default_options()   # shared with the batch mode
 
     def set_global_option(self, namespace_obj):
         '''
@@ -215,18 +251,18 @@ class Workbench_Tablewidget(QTableWidget):
 
 
         for i, file in enumerate(filepathslist):
-            self.sig_setProgressValue.emit(100/len(filepathslist) * i)
             if isinstance(file, QUrl):
                 file = file.toLocalFile()   # convert filepath from QUrl to a QString
             if not os.path.isfile(unicode(file)):
                continue   # override dirs!  just to be sure
 
             i = self.rowCount()
-            # Load Picture:
-            pic = QPixmap(file).scaled(100, 100, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            # Load Picture: (a placeholder, the thumbnail is created in the background see on_thumbnail_ready)
             picture_entry = QTableWidgetItem()
-            picture_entry.setData(Qt.DecorationRole, pic)
-            picture_entry.setData(Qt.UserRole, [None, None])   # there is no valid preview
+            picture_entry.setData(Qt.DecorationRole, self.placeholder)
+            picture_entry.setData(THUMBNAIL_ROLE, self.request_thumbnail(unicode(file)))
+            # there is no valid preview (image, md5, palette, height)
+            picture_entry.setData(Qt.UserRole, [None, None, None, -1])
 
             # Load Name:
             name = os.path.basename(unicode(file))
@@ -249,11 +285,90 @@ class Workbench_Tablewidget(QTableWidget):
             self.setItem(i, 1, name_entry)
             self.setItem(i, 2, size_entry)
             self.setCellWidget(i, 3, btn)
-            self.resizeRowsToContents()
 
-        self.sig_setProgressValue.emit(100)
+        self.resizeRowsToContents()
+        if not self.thumbnail_tasks:
+            self.sig_setProgressValue.emit(100)
         self.sig_filesAccepted.emit()
 
+    def request_thumbnail(self, file):
+        '''
+        Start creating the thumbnail of "file" in the thread pool.
+        :param file: unicode filepath
+        :return: id of the thumbnail, stored at the picture item with THUMBNAIL_ROLE
+        '''
+        if not self.thumbnail_tasks:
+            self.thumbnails_requested = 0   # a new batch starts
+        self.thumbnail_count += 1
+        self.thumbnails_requested += 1
+        task = _ThumbnailTask(self.thumbnail_count, file, self.thumbnail)
+        task.setAutoDelete(False)
+        task.emitter.sig_ready.connect(self.on_thumbnail_ready)
+        self.thumbnail_tasks[self.thumbnail_count] = task
+        if self.thumbnails_paused is not None:
+            self.thumbnails_paused.append(task)
+        else:
+            self.thumbnail_pool.start(task)
+        return self.thumbnail_count
+
+    def pause_thumbnails(self):
+        '''
+        Wait for the running thumbnails, new ones are only started by resume_thumbnails (e.g. while the worker
+        processes of an output run are forked, see MainWindow.on_go).
+        '''
+        if self.thumbnails_paused is None:
+            self.thumbnails_paused = []
+        self.thumbnail_pool.waitForDone()
+
+    def resume_thumbnails(self):
+        '''
+        Start the thumbnails requested since pause_thumbnails.
+        '''
+        tasks, self.thumbnails_paused = self.thumbnails_paused or [], None
+        for task in tasks:
+            self.thumbnail_pool.start(task)
+
+    @pyqtSlot(int, QImage)                   # Connected to _ThumbnailTask.emitter.sig_ready
+    def on_thumbnail_ready(self, thumbnail_id, image):
+        '''
+        Replace the placeholder of the item waiting for this thumbnail (rows might have been moved or removed in
+        the meantime).
+        '''
+        self.thumbnail_tasks.pop(thumbnail_id, None)
+        if not image.isNull():
+            for row in range(self.rowCount()):
+                item = self.item(row, 0)
+                if item is not None and item.data(THUMBNAIL_ROLE).toPyObject() == thumbnail_id:
+                    item.setData(Qt.DecorationRole, QPixmap.fromImage(image))
+                    self.resizeRowToContents(row)
+                    break
+        if self.thumbnail_tasks:
+            done = self.thumbnails_requested - len(self.thumbnail_tasks)
+            self.sig_setProgressValue.emit(max(1, 100 * done // self.thumbnails_requested))
+        else:
+            self.sig_setProgressValue.emit(100)
+
+    def thumbnail(self, file):
+        '''
+        Create the 100x100 thumbnail of an image file, or take it from the disk cache. (called in the thread pool)
+        :param file: unicode filepath
+        :return: QImage
+        '''
+        key = disk_key(file, None, 'thumbnail', 100)
+        data = self.disk_cache.get_bytes(key)
+        if data is not None:
+            image = QImage.fromData(data, "PNG")
+            if not image.isNull():
+                return image
+        image = read_image(file, 100, 100)   # decoded at the reduced size
+        byte_array = QByteArray()
+        buf = QBuffer(byte_array)
+        buf.open(QIODevice.WriteOnly)
+        image.save(buf, "PNG")
+        buf.close()
+        self.disk_cache.put_bytes(key, byte_array.data())
+        return image
+
     @pyqtSlot()                              # Connected to "clicked" of the "Remove" Buttons
     def onRemoveBtn(self):
         button = self.sender()
@@ -10,29 +10,40 @@ bleedthrough, etc.
 
 from __future__ import print_function
 
+import io
+import multiprocessing
 import numpy as np
 import os
 import re
 import shlex
 import subprocess
 import sys
+import time
 #from PIL import Image    # we do not need PIL, we use QImage (PyQt)
 
 from argparse import ArgumentParser
-from scipy.cluster.vq import kmeans, vq
+from copy import copy
+from multiprocessing.pool import ThreadPool
+# scipy.cluster.vq is imported where it is used (k-means and vq), it is
+# the slowest import of the pipeline and not needed e.g. for cached pages
 
 from PyQt4.QtGui import QImage, qRgb
-from PyQt4.QtCore import Qt
 
 import lib.qimage2ndarray as q2n   #lib for converting np.arrays to QImages and back
+import lib.Instrumentation as Instrumentation   # stage timers and counters
+from lib.RenderCache import DiskCache, disk_key, global_palette_key, labels_cache
+from lib.ImageReader import read_image, image_size, scaled_size
+from lib.PngWriter import IndexedPngWriter, choose_encoding
+from lib.PdfWriter import PdfWriter, bit_depth
 
 
 
 ######################################################################
 
-def quantize(image, bits_per_channel=None):
+def quantize(image, bits_per_channel=None, out=None):
 
-    '''Reduces the number of bits per channel in the given image.'''
+    '''Reduces the number of bits per channel in the given image. The
+result is a uint8 array, pass out=image to quantize in place.'''
 
     if bits_per_channel is None:
         bits_per_channel = 6
@@ -42,59 +53,73 @@ def quantize(image, bits_per_channel=None):
     shift = 8-bits_per_channel
     halfbin = (1 << shift) >> 1
 
-    return ((image.astype(int) >> shift) << shift) + halfbin
+    # clearing the low bits and setting the half bin is the same as
+    # ((x >> shift) << shift) + halfbin, but never leaves uint8
+    out = np.bitwise_and(image, (0xff << shift) & 0xff, out=out)
+    out |= halfbin
+
+    return out
 
 ######################################################################
 
-def pack_rgb(rgb):
+def pack_rgb(rgb, out=None):
 
     '''Packs a 24-bit RGB triples into a single integer,
-works on both arrays and tuples.'''
-
-    orig_shape = None
+works on both arrays and tuples. Arrays are packed into uint32 (or
+into out, an integer array of shape rgb.shape[:-1]).'''
 
-    if isinstance(rgb, np.ndarray):
-        assert rgb.shape[-1] == 3
-        orig_shape = rgb.shape[:-1]
-    else:
+    if not isinstance(rgb, np.ndarray):
         assert len(rgb) == 3
-        rgb = np.array(rgb)
+        rgb = np.array(rgb).astype(int).reshape((-1, 3))
+        return (rgb[:, 0] << 16 |
+                rgb[:, 1] << 8 |
+                rgb[:, 2])
 
-    rgb = rgb.astype(int).reshape((-1, 3))
+    assert rgb.shape[-1] == 3
 
-    packed = (rgb[:, 0] << 16 |
-              rgb[:, 1] << 8 |
-              rgb[:, 2])
+    if rgb.dtype.kind not in 'ui':
+        rgb = rgb.astype(int)
 
-    if orig_shape is None:
-        return packed
-    else:
-        return packed.reshape(orig_shape)
+    if out is None:
+        out = np.empty(rgb.shape[:-1], dtype=np.uint32)
+
+    # shift the channels in one after another, the only array of the
+    # full size is the result
+    out[...] = rgb[..., 0]
+    for channel in (1, 2):
+        out <<= 8
+        np.bitwise_or(out, rgb[..., channel], out=out, casting='unsafe')
+
+    return out
 
 ######################################################################
 
-def unpack_rgb(packed):
+def unpack_rgb(packed, out=None):
 
     '''Unpacks a single integer or array of integers into one or more
-24-bit RGB values.
+24-bit RGB values. Arrays of any integer type are unpacked into uint8
+(or into out, an array of shape packed.shape + (3,)).
 
     '''
 
-    orig_shape = None
+    if not isinstance(packed, np.ndarray):
+        return ((packed >> 16) & 0xff,
+                (packed >> 8) & 0xff,
+                (packed) & 0xff)
 
-    if isinstance(packed, np.ndarray):
-        assert packed.dtype == int
-        orig_shape = packed.shape
-        packed = packed.reshape((-1, 1))
+    assert np.issubdtype(packed.dtype, np.integer)
 
-    rgb = ((packed >> 16) & 0xff,
-           (packed >> 8) & 0xff,
-           (packed) & 0xff)
+    if out is None:
+        out = np.empty(packed.shape + (3,), dtype=np.uint8)
 
-    if orig_shape is None:
-        return rgb
-    else:
-        return np.hstack(rgb).reshape(orig_shape + (3,))
+    channel = np.empty_like(packed)
+
+    for index, shift in enumerate((16, 8, 0)):
+        np.right_shift(packed, shift, out=channel)
+        channel &= 0xff
+        out[..., index] = channel
+
+    return out
 
 ######################################################################
 
@@ -108,7 +133,42 @@ one.
 
     assert image.shape[-1] == 3
 
-    quantized = quantize(image, bits_per_channel).astype(int)
+    if bits_per_channel is None:
+        bits_per_channel = 6
+
+    assert image.dtype == np.uint8
+
+    start = time.time()
+
+    # count the bins directly instead of sorting: the bin index has
+    # the same order as the packed quantized color, so ties are broken
+    # the same way as with np.unique()
+    index = get_lut_index(image.reshape((-1, 3)), bits_per_channel)
+    counts = np.bincount(index, minlength=1 << (3*bits_per_channel))
+    mode = int(counts.argmax())
+
+    shift = 8-bits_per_channel
+    halfbin = (1 << shift) >> 1
+    mask = (1 << bits_per_channel) - 1
+
+    packed_mode = 0
+    for channel_shift in (2*bits_per_channel, bits_per_channel, 0):
+        level = (((mode >> channel_shift) & mask) << shift) + halfbin
+        packed_mode = (packed_mode << 8) | level
+
+    Instrumentation.record('bg_color', time.time()-start,
+                           samples=len(index))
+
+    return unpack_rgb(np.int_(packed_mode))
+
+######################################################################
+
+def get_bg_color_unique(image, bits_per_channel=None):
+
+    '''Reference implementation of get_bg_color() which sorts the
+packed colors with np.unique() instead of counting the bins.'''
+
+    quantized = quantize(image, bits_per_channel)
     packed = pack_rgb(quantized)
 
     unique, counts = np.unique(packed, return_counts=True)
@@ -144,9 +204,23 @@ value.
 
 ######################################################################
 
-def postprocess(output_filename, options):
+def is_pipe_command(cmd):
+
+    '''A postprocessing command without %i and %o reads the PNG from
+stdin and writes the result to stdout (e.g. "pngquant -").'''
+
+    return '%i' not in cmd and '%o' not in cmd
+
+######################################################################
+
+def postprocess(output_filename, options, data=None):
 
-    '''Runs the postprocessing command on the file provided.'''
+    '''Runs the postprocessing command on the file provided. A pipe
+command (see is_pipe_command()) gets the PNG through stdin, data are
+the encoded bytes of the PNG if it has not been written to
+output_filename. Returns a tuple (post_filename, size before, size
+after), or None if the command failed. Can be called from several
+threads at once.'''
 
     assert options.postprocess_cmd
 
@@ -163,32 +237,98 @@ def postprocess(output_filename, options):
     if os.path.exists(post_filename):
         os.unlink(post_filename)
 
-    if not options.quiet:
-        print('  running "{}"...'.format(cmd), end=' ')
-        sys.stdout.flush()
+    start = time.time()
 
     try:
-        result = subprocess.call(subprocess_args)
-        before = os.stat(output_filename).st_size
-        after = os.stat(post_filename).st_size
-    except OSError:
+        if is_pipe_command(options.postprocess_cmd):
+            if data is None:
+                with open(output_filename, 'rb') as f:
+                    data = f.read()
+            process = subprocess.Popen(subprocess_args,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+            result_data, _ = process.communicate(data)
+            result = process.returncode
+            if result == 0:
+                with open(post_filename, 'wb') as f:
+                    f.write(result_data)
+            before, after = len(data), len(result_data)
+        else:
+            before = os.stat(output_filename).st_size
+            result = subprocess.call(subprocess_args)
+            after = os.stat(post_filename).st_size
+    except (OSError, IOError):
         result = -1
 
     if result == 0:
 
+        Instrumentation.record('postprocess', time.time()-start,
+                               bytes_before=before, bytes_after=after)
+
         if not options.quiet:
-            print('{:.1f}% reduction'.format(
-                100*(1.0-float(after)/before)))
+            print('  ran "{}": {:.1f}% reduction'.format(
+                cmd, 100*(1.0-float(after)/before)))
 
-        return post_filename
+        return post_filename, before, after
 
     else:
 
-        sys.stderr.write('warning: postprocessing failed!\n')
+        sys.stderr.write('warning: postprocessing {} failed!\n'.format(
+            output_filename))
         return None
 
 ######################################################################
 
+def write_output(output_filename, labels, palette, dpi, options):
+
+    '''Save a page and run the postprocessing command on it (executed
+by the output threads of notescan_main()). With a pipe command the
+PNG is only encoded in memory and piped through the command. Labels
+may be None if the page has already been saved (strip mode). Returns a
+tuple (final filename, postprocessing result of postprocess() or
+None).'''
+
+    if not options.postprocess_cmd:
+        if labels is not None:
+            save(output_filename, labels, palette, dpi, options)
+        return output_filename, None
+
+    data = None
+    if labels is not None:
+        if is_pipe_command(options.postprocess_cmd):
+            buf = io.BytesIO()
+            write_png(buf, labels, finalize_palette(palette, options), dpi)
+            data = buf.getvalue()
+        else:
+            save(output_filename, labels, palette, dpi, options)
+
+    result = postprocess(output_filename, options, data)
+    if result is None:
+        if data is not None:
+            # the page has not been written yet, keep the unprocessed one
+            with open(output_filename, 'wb') as f:
+                f.write(data)
+        return output_filename, None
+
+    return result[0], result
+
+######################################################################
+
+def postprocess_report(results):
+
+    '''Summary line of the postprocessing of a run; results are the
+postprocessing results of write_output().'''
+
+    results = [result for result in results if result is not None]
+    before = sum(result[1] for result in results)
+    after = sum(result[2] for result in results)
+
+    return 'postprocessed {} files: {} -> {} bytes ({:.1f}% reduction)'.format(
+        len(results), before, after,
+        100*(1.0-float(after)/before) if before else 0.0)
+
+######################################################################
+
 def percent(string):
     '''Convert a string (i.e. 85) to a fraction (i.e. .85).'''
     return float(string)/100.0
@@ -237,6 +377,20 @@ def get_argument_parser():
                         type=percent, default='5',
                         help='%% of pixels to sample' + show_default)
 
+    parser.add_argument('-m', dest='sample_method', metavar='METHOD',
+                        choices=sorted(SAMPLE_METHODS), default='random',
+                        help='pixel sampling method, one of ' +
+                        ', '.join(sorted(SAMPLE_METHODS)) + show_default)
+
+    parser.add_argument('-r', dest='sample_seed', metavar='SEED',
+                        type=int, default=0,
+                        help='seed of the pixel sampling' + show_default)
+
+    parser.add_argument('-H', dest='sample_height', metavar='ROWS',
+                        type=int, default=0,
+                        help='sample the palette from a copy of each page '
+                        'decoded at only ROWS rows (default off)')
+
     parser.add_argument('-w', dest='white_bg', action='store_true',
                         default=False, help='make background white')
 
@@ -244,6 +398,22 @@ def get_argument_parser():
                         action='store_true', default=False,
                         help='use one global palette for all pages')
 
+    parser.add_argument('-j', dest='workers', metavar='JOBS',
+                        type=int, default=None,
+                        help='number of processes loading the pages for '
+                        '-g (default one per cpu core)')
+
+    parser.add_argument('-k', dest='kmeans_method', metavar='METHOD',
+                        choices=sorted(KMEANS_METHODS), default='full',
+                        help='clustering method, one of ' +
+                        ', '.join(sorted(KMEANS_METHODS)) + show_default)
+
+    parser.add_argument('-T', dest='kmeans_tol', metavar='TOL',
+                        type=float, default=None,
+                        help='clustering convergence tolerance (relative '
+                        'distortion change for full, center movement for '
+                        'minibatch)')
+
     parser.add_argument('-S', dest='saturate', action='store_false',
                         default=True, help='do not saturate colors')
 
@@ -276,9 +446,39 @@ def get_argument_parser():
                         const='pngquant --ext %e %i',
                         help='same as -P "%(const)s"')
 
+    parser.add_argument('-t', dest='strip_height', metavar='ROWS',
+                        type=int, default=0,
+                        help='label and save each page in strips of ROWS '
+                        'rows to bound the memory use for very large '
+                        'scans (default off)')
+
+    parser.add_argument('-Z', dest='postprocess_cmd',
+                        action='store_const',
+                        const='pngquant -',
+                        help='same as -P "%(const)s" (a command without '
+                        '%%i and %%o gets the PNG piped through stdin and '
+                        'stdout)')
+
+    parser.add_argument('-E', dest='encode_threads', metavar='THREADS',
+                        type=int, default=0,
+                        help='encode and postprocess the PNGs in THREADS '
+                        'background threads (default 0: in the main '
+                        'thread, with a postprocessing command one thread '
+                        'per cpu core)')
+
+    parser.add_argument('-D', dest='cache_dir', metavar='DIR', default=None,
+                        help='cache palettes and labels in DIR, pages which '
+                        'did not change are not computed again')
+
+    parser.add_argument('-X', dest='timings', action='store_true',
+                        default=False,
+                        help='print the time and the counters of every '
+                        'stage (load, sample, kmeans, save, ...) at the end')
+
     parser.add_argument('-c', dest='pdf_cmd', metavar="COMMAND",
-                        default='convert %i %o',
-                        help='PDF command (default "%(default)s")')
+                        default=None,
+                        help='PDF command, e.g. "convert %%i %%o" (default: '
+                        'built-in PDF writer)')
 
     return parser
 
@@ -316,14 +516,20 @@ pages ordered correctly.
 
 def load(input_filename, height):
 
-    '''Load an image with Pillow and convert it to numpy array. Also
-returns the image DPI in x and y as a tuple.'''
+    '''Load an image with Qt and convert it to numpy array. Also
+returns the image DPI in x and y as a tuple. If height is not -1,
+larger images are decoded at the reduced height directly (see
+lib.ImageReader.read_image).'''
+
+    start = time.time()
 
     try:
         #pil_img = Image.open(input_filename)
-        pil_img = QImage(input_filename)
-        if pil_img.height() > height and not height == -1:     #if the picture is larger than the requested max-height, scale it.
-            pil_img = pil_img.scaledToHeight(height, Qt.SmoothTransformation)
+        pil_img = read_image(input_filename, max_height=height)
+        if pil_img.isNull():
+            raise IOError(input_filename)
+        if pil_img.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+            pil_img = pil_img.convertToFormat(QImage.Format_RGB32)   # e.g. indexed PNGs
 
     except IOError:
         sys.stderr.write('warning: error opening {}\n'.format(
@@ -335,32 +541,260 @@ returns the image DPI in x and y as a tuple.'''
     #img = np.array(pil_img)
     img = q2n.rgb_view(pil_img)
 
+    Instrumentation.record('load', time.time()-start,
+                           pixels=img.shape[0]*img.shape[1])
+
     return img, dpi
 
 ######################################################################
 
-def sample_pixels(img, options):
+def get_rng(seed=None):
 
-    '''Pick a fixed percentage of pixels in the image, returned in random
-order.'''
+    '''Random number generator for the sampling. numpy's Generator
+(default_rng) if available, otherwise the legacy RandomState; both
+provide shuffle() and permutation().'''
 
-    pixels = img.reshape((-1, 3))
-    num_pixels = pixels.shape[0]
-    num_samples = int(num_pixels*options.sample_fraction)
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seed)
+
+    return np.random.RandomState(seed)
+
+######################################################################
+
+def random_indices(rng, num_pixels, num_samples):
+
+    '''Draw num_samples distinct indices below num_pixels in random
+order. For small fractions the indices are drawn with replacement and
+the duplicates are replaced, which needs O(num_samples) memory instead
+of a permutation of all pixels.'''
+
+    if num_samples > num_pixels // 2:
+        return rng.permutation(num_pixels)[:num_samples]
+
+    draw = getattr(rng, 'integers', None) or rng.randint
+
+    idx = np.empty(0, dtype=np.int64)
+    while len(idx) < num_samples:
+        extra = draw(0, num_pixels, size=num_samples-len(idx))
+        # sort and drop duplicates (cheaper than np.unique)
+        idx = np.sort(np.concatenate((idx, extra)))
+        idx = idx[np.concatenate(([True], idx[1:] != idx[:-1]))]
+
+    rng.shuffle(idx)
+
+    return idx
+
+######################################################################
+
+def sample_random(img, num_samples, rng):
+
+    '''Uniform random samples without replacement. The pixels are
+gathered by row and column, so the image is never reshaped (which
+would copy a non-contiguous view of a QImage).'''
+
+    height, width = img.shape[:2]
+
+    idx = random_indices(rng, height*width, num_samples)
+    rows, cols = np.divmod(idx, width)
+
+    return img[rows, cols]
+
+######################################################################
+
+def sample_stride(img, num_samples, rng):
+
+    '''Samples on a regular grid with a random offset, returned in
+random order. The grid spacing is chosen so that about num_samples
+pixels are hit.'''
+
+    height, width = img.shape[:2]
+
+    step = max(1, int(np.sqrt(float(height*width)/max(num_samples, 1))))
+    draw = getattr(rng, 'integers', None) or rng.randint
+    row0, col0 = int(draw(step)), int(draw(step))
+
+    samples = img[row0::step, col0::step].reshape((-1, 3))
+    samples = samples[rng.permutation(len(samples))[:num_samples]]
+
+    return samples
+
+######################################################################
+
+SAMPLE_METHODS = {
+    'random': sample_random,
+    'stride': sample_stride,
+}
+
+# size of the sample reservoir of get_global_palette()
+GLOBAL_PALETTE_SAMPLES = 1 << 19
+
+######################################################################
+
+def sample_pixels(img, options, rng=None, num_samples=None):
+
+    '''Pick a fixed percentage of pixels in the image (or num_samples
+pixels), returned in random order.
+
+The sampling method is chosen with options.sample_method (see
+SAMPLE_METHODS). Unless a generator is passed as rng, a new one is
+seeded with options.sample_seed, so the same options always give the
+same samples.
+
+    '''
+
+    if rng is None:
+        rng = get_rng(getattr(options, 'sample_seed', None))
+
+    num_pixels = img.shape[0]*img.shape[1]
 
-    idx = np.arange(num_pixels)
-    np.random.shuffle(idx)
+    if num_samples is None:
+        num_samples = int(num_pixels*options.sample_fraction)
 
-    return pixels[idx[:num_samples]]
+    num_samples = min(num_samples, num_pixels)
+
+    method = SAMPLE_METHODS[getattr(options, 'sample_method', None) or
+                            'random']
+
+    start = time.time()
+    samples = method(img, num_samples, rng)
+    Instrumentation.record('sample', time.time()-start,
+                           pixels=num_pixels, samples=len(samples))
+
+    return samples
+
+######################################################################
+
+def sample_at_decode(input_filename, height, options, rng=None):
+
+    '''Samples for the palette of a page which is used at the given
+height (-1 for full size), taken from a copy decoded at only
+options.sample_height rows (see lib.ImageReader.read_image). As many
+samples as for the page at its used size are requested, but at most
+all pixels of the decoded copy are returned: with a sample fraction f
+the copy needs about sqrt(f) of the used height (e.g. 740 of 3300 rows
+for 5%), a smaller sample_height gives fewer samples.
+
+Returns None if options.sample_height is not set or the page is not
+larger than that, the page has to be sampled with sample_pixels(). rng
+is passed on to sample_pixels().
+
+    '''
+
+    sample_height = getattr(options, 'sample_height', None)
+    if not sample_height or sample_height <= 0:
+        return None
+
+    size = image_size(input_filename)
+    if size is None:
+        return None
+
+    size = scaled_size(size, max_height=height)
+    if size.height() <= sample_height:
+        return None
+
+    small, _ = load(input_filename, sample_height)
+    if small is None:
+        return None
+
+    num_samples = int(size.width()*size.height()*options.sample_fraction)
+
+    return sample_pixels(small, options, rng, num_samples)
 
 ######################################################################
 
-def get_fg_mask(bg_color, samples, options):
+def get_fg_mask(bg_color, samples, options, out=None, chunk_size=None,
+                lut=None):
 
     '''Determine whether each pixel in a set of samples is foreground by
 comparing it to the background color. A pixel is classified as a
 foreground pixel if either its value or saturation differs from the
-background by a threshold.'''
+background by a threshold.
+
+Saturation and value only depend on the largest and the smallest
+channel of a pixel, so the classification is looked up in the table of
+get_fg_mask_lut(): per chunk of chunk_size pixels only the uint8 max
+and min channels and a uint16 index are allocated. The result is
+written to out (a boolean array of shape samples.shape[:-1]) if given.
+A table computed before for the same background color and options can
+be passed as lut.
+
+    '''
+
+    start_time = time.time()   # start is the chunk offset below
+
+    if samples.dtype != np.uint8:
+        mask = get_fg_mask_sv(bg_color, samples, options)
+        if out is not None:
+            out[...] = mask
+            mask = out
+        Instrumentation.record('fg_mask', time.time()-start_time,
+                               pixels=mask.size)
+        return mask
+
+    if chunk_size is None:
+        chunk_size = 1 << 20
+
+    if lut is None:
+        lut = get_fg_mask_lut(bg_color, options)
+    lut = lut.reshape(-1)
+
+    if out is None:
+        out = np.empty(samples.shape[:-1], dtype=bool)
+
+    assert out.shape == samples.shape[:-1] and out.flags.c_contiguous
+
+    pixels = samples.reshape((-1, 3))
+    flat_out = out.reshape(-1)
+
+    cmax = np.empty(min(chunk_size, len(pixels)), dtype=np.uint8)
+    cmin = np.empty_like(cmax)
+    index = np.empty(len(cmax), dtype=np.uint16)
+
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start+chunk_size]
+        count = len(chunk)
+        np.maximum(chunk[:, 0], chunk[:, 1], out=cmax[:count])
+        np.maximum(cmax[:count], chunk[:, 2], out=cmax[:count])
+        np.minimum(chunk[:, 0], chunk[:, 1], out=cmin[:count])
+        np.minimum(cmin[:count], chunk[:, 2], out=cmin[:count])
+        index[:count] = cmax[:count]
+        index[:count] <<= 8
+        index[:count] |= cmin[:count]
+        np.take(lut, index[:count], out=flat_out[start:start+count])
+
+    Instrumentation.record('fg_mask', time.time()-start_time,
+                           pixels=len(pixels))
+
+    return out
+
+######################################################################
+
+def get_fg_mask_lut(bg_color, options):
+
+    '''Foreground classification of get_fg_mask_sv() for every pair of
+largest and smallest channel, as a boolean array of shape (256, 256)
+indexed by [max, min]. The table is computed with the floating point
+formulas of rgb_to_sv(), so the lookup gives exactly the same result.'''
+
+    levels = np.arange(256, dtype=np.uint8)
+
+    # the pixel (max, min, min) has the given largest and smallest
+    # channel, entries with min > max never occur
+    pixels = np.empty((256, 256, 3), dtype=np.uint8)
+    pixels[:, :, 0] = levels[:, None]
+    pixels[:, :, 1] = np.minimum(levels[:, None], levels[None, :])
+    pixels[:, :, 2] = pixels[:, :, 1]
+
+    # max == 0 is black, its saturation is 0 (see rgb_to_sv())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return get_fg_mask_sv(bg_color, pixels, options)
+
+######################################################################
+
+def get_fg_mask_sv(bg_color, samples, options):
+
+    '''Reference implementation of get_fg_mask() which converts every
+sample to saturation and value with rgb_to_sv().'''
 
     s_bg, v_bg = rgb_to_sv(bg_color)
     s_samples, v_samples = rgb_to_sv(samples)
@@ -373,13 +807,216 @@ background by a threshold.'''
 
 ######################################################################
 
-def get_palette(samples, options, return_mask=False, kmeans_iter=40):
+def kmeans_full(data, num_centers, init=None, max_iter=40, tol=None):
+
+    '''Cluster with scipy's k-means. Without an initial guess the
+clustering is restarted max_iter times and the best result is kept;
+with a guess (shape (num_centers, 3)) a single run is started from it.
+tol is the relative change of the distortion at which a run stops.
+
+    '''
+
+    from scipy.cluster.vq import kmeans
+
+    if tol is None:
+        tol = 1e-5
+
+    start = time.time()
+
+    if init is not None:
+        centers, _ = kmeans(data, init.astype(np.float32), thresh=tol)
+    else:
+        centers, _ = kmeans(data, num_centers, iter=max_iter, thresh=tol)
+
+    Instrumentation.record('kmeans', time.time()-start, samples=len(data))
+
+    return centers
+
+######################################################################
+
+def kmeans_plusplus(data, num_centers, rng, max_samples=4096):
+
+    '''Choose initial centers with k-means++ seeding: the first center
+is a random sample, every further one is drawn with a probability
+proportional to the squared distance to the nearest chosen center. So
+samples of an already chosen color are never drawn again as long as
+other colors are left. Only a random subset of at most max_samples
+samples is considered.
+
+    '''
+
+    num_samples = data.shape[0]
+    if num_samples > max_samples:
+        data = data[rng.choice(num_samples, max_samples, replace=False)]
+        num_samples = max_samples
+
+    data = data.astype(np.float64)
+    centers = np.empty((num_centers, data.shape[1]))
+
+    centers[0] = data[rng.randint(num_samples)]
+    dist = ((data - centers[0])**2).sum(axis=1)
+
+    for i in range(1, num_centers):
+        total = dist.sum()
+        if total > 0:
+            centers[i] = data[rng.choice(num_samples, p=dist/total)]
+        else:
+            centers[i] = data[rng.randint(num_samples)]
+        dist = np.minimum(dist, ((data - centers[i])**2).sum(axis=1))
+
+    return centers
+
+######################################################################
+
+def reseed_centers(centers, counts, batch, min_dist=1.0):
+
+    '''Move the centers which did not win a sample (counts == 0) or
+which duplicate another center (closer than min_dist) to the samples
+of batch farthest from the remaining centers, one after another like
+kmeans_plusplus(). Returns the indices of the moved centers.
+
+    '''
+
+    num_centers = len(centers)
+
+    dead = counts == 0
+    for i in range(num_centers):
+        if dead[i]:
+            continue
+        diff = centers[i+1:] - centers[i]
+        dead[i+1:] |= (diff**2).sum(axis=1) < min_dist**2
+
+    if not dead.any() or dead.all():
+        return np.array([], dtype=int)
+
+    dist = np.min([((batch - center)**2).sum(axis=1)
+                   for center in centers[~dead]], axis=0)
+
+    moved = []
+    for i in np.flatnonzero(dead):
+        j = dist.argmax()
+        if dist[j] < min_dist**2:
+            break                      # no other color left in the batch
+        centers[i] = batch[j]
+        dist = np.minimum(dist, ((batch - centers[i])**2).sum(axis=1))
+        moved.append(i)
+
+    return np.array(moved, dtype=int)
+
+######################################################################
+
+def kmeans_minibatch(data, num_centers, init=None, max_iter=100, tol=None,
+                     batch_size=1024, reseed_every=10):
+
+    '''Cluster with mini-batch k-means: every iteration assigns a small
+random batch to the nearest centers and moves each center towards the
+mean of its batch members with a learning rate that decreases with the
+number of members seen so far. Stops after max_iter batches or as soon
+as no center moves more than tol (in color units). A warm start from
+init only needs a few batches.
+
+Without init the centers are seeded with kmeans_plusplus(). Every
+reseed_every batches, and before stopping, centers which won no sample
+since the last check or duplicate another center are moved to poorly
+represented samples (see reseed_centers()), so two inks are not merged
+into one center while another one stays unused. If the data has fewer
+distinct colors than num_centers, the remaining duplicates are dropped
+like scipy's kmeans drops centers without members, so fewer centers are
+returned. Meant for the previews; the outputs are clustered with
+kmeans_full().
+
+    '''
+
+    from scipy.cluster.vq import vq
+
+    if tol is None:
+        tol = 0.5
+
+    rng = np.random.RandomState(0)
+    num_samples = data.shape[0]
+
+    if init is not None:
+        centers = init.astype(np.float64)
+        # the guess counts as much as one batch, so it is refined
+        # instead of being replaced by the first batch
+        seen = np.full(num_centers, float(batch_size)/num_centers)
+    else:
+        centers = kmeans_plusplus(data, num_centers, rng)
+        seen = np.zeros(num_centers)
+
+    start = time.time()
+    iterations = 0
+    wins = np.zeros(num_centers, dtype=int)   # since the last reseeding
+
+    for _ in range(max_iter):
+
+        iterations += 1
+
+        batch = data[rng.randint(0, num_samples, batch_size)]
+        labels, _ = vq(batch, centers)
+
+        counts = np.bincount(labels, minlength=num_centers)
+        sums = np.zeros((num_centers, 3))
+        for channel in range(3):
+            sums[:, channel] = np.bincount(labels, weights=batch[:, channel],
+                                           minlength=num_centers)
+
+        hit = counts > 0
+        wins += counts
+        seen[hit] += counts[hit]
+        rate = (counts[hit] / seen[hit])[:, None]
+        means = sums[hit] / counts[hit][:, None]
+
+        movement = rate * (means - centers[hit])
+        centers[hit] += movement
+
+        converged = not len(movement) or np.abs(movement).max() < tol
+
+        if converged or iterations % reseed_every == 0:
+            moved = reseed_centers(centers, wins, batch)
+            wins[:] = 0
+            if len(moved):
+                seen[moved] = 0        # the first batch replaces the seed
+                continue
+
+        if converged:
+            break
+
+    Instrumentation.record('kmeans', time.time()-start, samples=num_samples,
+                           iterations=iterations)
+
+    # duplicates are left if reseed_centers() found no other color
+    keep = np.ones(num_centers, dtype=bool)
+    for i in range(num_centers):
+        if keep[i]:
+            diff = centers[i+1:] - centers[i]
+            keep[i+1:] &= (diff**2).sum(axis=1) >= 1.0
+
+    return centers[keep]
+
+######################################################################
+
+KMEANS_METHODS = {
+    'full': kmeans_full,
+    'minibatch': kmeans_minibatch,
+}
+
+######################################################################
+
+def get_palette(samples, options, return_mask=False, kmeans_iter=None,
+                init_palette=None):
 
     '''Extract the palette for the set of sampled RGB values. The first
 palette entry is always the background color; the rest are determined
 from foreground pixels by running K-means clustering. Returns the
 palette, as well as a mask corresponding to the foreground pixels.
 
+The clustering method is chosen with options.kmeans_method (see
+KMEANS_METHODS), options.kmeans_tol sets its convergence tolerance. A
+previous palette of the same image can be passed as init_palette to
+warm-start the clustering; it is ignored if the number of colors has
+changed.
+
     '''
 
     if not options.quiet:
@@ -389,9 +1026,19 @@ palette, as well as a mask corresponding to the foreground pixels.
 
     fg_mask = get_fg_mask(bg_color, samples, options)
 
-    centers, _ = kmeans(samples[fg_mask].astype(np.float32),
-                        options.num_colors-1,
-                        iter=kmeans_iter)
+    num_centers = options.num_colors-1
+
+    init = None
+    if init_palette is not None and len(init_palette) == options.num_colors:
+        init = np.asarray(init_palette)[1:]
+
+    method = KMEANS_METHODS[getattr(options, 'kmeans_method', 'full')]
+    kwargs = {'init': init, 'tol': getattr(options, 'kmeans_tol', None)}
+    if kmeans_iter is not None:
+        kwargs['max_iter'] = kmeans_iter
+
+    centers = method(samples[fg_mask].astype(np.float32), num_centers,
+                     **kwargs)
 
     palette = np.vstack((bg_color, centers)).astype(np.uint8)
 
@@ -402,32 +1049,132 @@ palette, as well as a mask corresponding to the foreground pixels.
 
 ######################################################################
 
-def apply_palette(img, palette, options):
+def get_palette_lut(palette, bits_per_channel=None):
+
+    '''Precompute the index of the nearest palette entry for every bin
+of colors quantized to the given number of bits per channel. A bin
+gets the entry 255 if its colors do not all share the same nearest
+palette entry; these must be resolved exactly. Returns a flat uint8
+array indexed by get_lut_index().
+
+    '''
+
+    if bits_per_channel is None:
+        bits_per_channel = 6
+
+    palette = np.asarray(palette, dtype=np.float64)
+    assert len(palette) < 255
+
+    shift = 8-bits_per_channel
+    maxoffset = ((1 << shift) - 1) / 2.0
+
+    # the center of each bin, every color of the bin is at most
+    # radius away from it
+    levels = (np.arange(1 << bits_per_channel) << shift) + maxoffset
+    radius = np.sqrt(3.0) * maxoffset
+
+    red = levels[:, None, None]
+    green = levels[None, :, None]
+    blue = levels[None, None, :]
+
+    shape = (len(levels),)*3
+    best = np.full(shape, np.inf)
+    second = np.full(shape, np.inf)
+    lut = np.zeros(shape, dtype=np.uint8)
+
+    for i, (r, g, b) in enumerate(palette):
+        dist = (red - r)**2 + (green - g)**2 + (blue - b)**2
+        closer = dist < best
+        second = np.where(closer, best, np.minimum(second, dist))
+        best = np.where(closer, dist, best)
+        lut[closer] = i
+
+    # by the triangle inequality the nearest entry is the same for the
+    # whole bin if the two closest entries are separated by more than
+    # the diameter of the bin
+    ambiguous = np.sqrt(second) - np.sqrt(best) <= 2*radius + 1e-6
+    lut[ambiguous] = 255
+
+    return lut.reshape(-1)
+
+######################################################################
+
+def get_lut_index(pixels, bits_per_channel=None):
+
+    '''Map an array of 8-bit RGB colors (shape (N, 3)) to their bin in
+the lookup table built by get_palette_lut().'''
+
+    if bits_per_channel is None:
+        bits_per_channel = 6
+
+    shift = 8-bits_per_channel
+
+    index = (pixels[:, 0] >> shift).astype(np.uint32)
+    index <<= bits_per_channel
+    index |= pixels[:, 1] >> shift
+    index <<= bits_per_channel
+    index |= pixels[:, 2] >> shift
+
+    return index
+
+######################################################################
+
+def apply_palette(img, palette, options, use_lut=True, palette_lut=None,
+                  fg_mask_lut=None):
 
     '''Apply the pallete to the given image. The first step is to set all
 background pixels to the background color; then, nearest-neighbor
 matching is used to map each foreground color to the closest one in
 the palette.
 
+By default the matching is done with a precomputed lookup table (see
+get_palette_lut()), only colors close to a decision boundary are
+matched exactly with vq(). The result is the same as with
+use_lut=False. Tables computed before for the same palette and options
+(get_palette_lut() and get_fg_mask_lut()) can be passed, e.g. when an
+image is labeled strip by strip.
+
     '''
 
     if not options.quiet:
         print('  applying palette...')
 
+    start = time.time()
+
     bg_color = palette[0]
 
-    fg_mask = get_fg_mask(bg_color, img, options)
+    fg_mask = get_fg_mask(bg_color, img, options, lut=fg_mask_lut)
 
     orig_shape = img.shape
 
     pixels = img.reshape((-1, 3))
-    fg_mask = fg_mask.flatten()
+    fg_mask = fg_mask.reshape(-1)
 
     num_pixels = pixels.shape[0]
 
     labels = np.zeros(num_pixels, dtype=np.uint8)
 
-    labels[fg_mask], _ = vq(pixels[fg_mask], palette)
+    fg_pixels = pixels[fg_mask]
+    exact = len(fg_pixels)
+
+    if use_lut and img.dtype == np.uint8 and len(palette) < 255:
+        lut = palette_lut
+        if lut is None:
+            lut = get_palette_lut(palette)
+        fg_labels = lut[get_lut_index(fg_pixels)]
+        unresolved = np.flatnonzero(fg_labels == 255)
+        exact = len(unresolved)
+        if len(unresolved):
+            from scipy.cluster.vq import vq
+            fg_labels[unresolved], _ = vq(fg_pixels[unresolved], palette)
+        labels[fg_mask] = fg_labels
+    else:
+        from scipy.cluster.vq import vq
+        labels[fg_mask], _ = vq(fg_pixels, palette)
+
+    Instrumentation.record('apply_palette', time.time()-start,
+                           pixels=num_pixels, fg_pixels=len(fg_pixels),
+                           exact=exact)
 
     return labels.reshape(orig_shape[:-1])
 
@@ -445,73 +1192,289 @@ the background color to pure white.
     if not options.quiet:
         print('  saving {}...'.format(output_filename))
 
-    if options.saturate:
-        palette = palette.astype(np.float32)
-        pmin = palette.min()
-        pmax = palette.max()
-        palette = 255 * (palette - pmin)/(pmax-pmin)
-        palette = palette.astype(np.uint8)
-
-    if options.white_bg:
-        palette = palette.copy()
-        palette[0] = (255, 255, 255)
+    palette = finalize_palette(palette, options)
 
     #output_img = Image.fromarray(labels, 'P')    #QImage.fromData(QByteArray, Format)
     #output_img.putpalette(palette.flatten())
     #output_img.save(output_filename, dpi=dpi)
 
-    QtImage = q2n.gray2qimage(labels, False)
+    write_png(output_filename, labels, palette, dpi)
 
-    nestedColorMap = palette
-    colors = []
-    for color in nestedColorMap:
-        r, g, b = color
-        colors.append(qRgb(r, g, b))
-    QtImage.setColorTable(colors)
-    QtImage.save(output_filename)
+######################################################################
+
+def write_png(output_filename, labels, palette, dpi=None):
+
+    '''Write a label/palette pair (with a finalized palette) as indexed
+PNG with as few bits per pixel as the palette allows, and the row
+filter and zlib settings which compress this page best (see
+lib.PngWriter.choose_encoding). zlib releases the GIL, so several
+pages can be encoded by threads at the same time.'''
+
+    start = time.time()
+
+    bits = bit_depth(len(palette))
+    filter_type, strategy, level = choose_encoding(labels, bits)
+
+    writer = IndexedPngWriter(output_filename, labels.shape[1],
+                              labels.shape[0], palette, dpi=dpi,
+                              level=level, bits=bits, strategy=strategy,
+                              filter_type=filter_type)
+
+    # in strips, so the filtered copy of the rows stays small
+    for strip in iter_strips(labels, 256):
+        writer.write_rows(strip)
+
+    writer.close()
+
+    Instrumentation.record('save', time.time()-start,
+                           pixels=labels.size, bytes=writer.bytes_written)
 
 ######################################################################
 
-def get_global_palette(filenames, options):
+def iter_strips(img, strip_height):
 
-    '''Fetch the global palette for a series of input files by merging
-their samples together into one large array.
+    '''Yield consecutive horizontal strips of at most strip_height rows
+of an image. The strips are views, nothing is copied.'''
 
-    '''
+    for start in range(0, img.shape[0], strip_height):
+        yield img[start:start+strip_height]
+
+######################################################################
+
+def sample_pixels_strips(img, options, strip_height):
+
+    '''Same as sample_pixels(), but the image is processed strip by
+strip, so only one strip at a time is copied.'''
+
+    rng = get_rng(getattr(options, 'sample_seed', None))
 
-    input_filenames = []
+    samples = np.vstack([sample_pixels(strip, options, rng)
+                         for strip in iter_strips(img, strip_height)])
+    rng.shuffle(samples)
 
-    all_samples = []
+    return samples
+
+######################################################################
+
+def save_strips(output_filename, img, palette, dpi, options, strip_height,
+                pdf=None):
+
+    '''Label the image with the palette and save it as indexed PNG
+strip by strip (see save() and apply_palette()). Besides the image
+itself only the temporaries of one strip are held in memory. If a
+PdfWriter is given, the strips are added to it as a new page, too.
+
+The lookup tables of apply_palette() are built once for all strips,
+the PNG encoding is chosen on the first strip (see write_png()).
+
+    '''
 
     if not options.quiet:
-        print('building global palette...')
+        print('  applying palette and saving {}...'.format(output_filename))
+
+    start = time.time()
+
+    strip_options = copy(options)
+    strip_options.quiet = True
+
+    final_palette = finalize_palette(palette, options)
+    bits = bit_depth(len(final_palette))
+
+    palette_lut = fg_mask_lut = None
+    if img.dtype == np.uint8:
+        fg_mask_lut = get_fg_mask_lut(palette[0], options)
+        if len(palette) < 255:
+            palette_lut = get_palette_lut(palette)
+
+    writer = None
+    if pdf is not None:
+        pdf.begin_page(img.shape[1], img.shape[0], final_palette, dpi)
+
+    for strip in iter_strips(img, strip_height):
+        labels = apply_palette(strip, palette, strip_options,
+                               palette_lut=palette_lut,
+                               fg_mask_lut=fg_mask_lut)
+        if writer is None:
+            filter_type, strategy, level = choose_encoding(labels, bits)
+            writer = IndexedPngWriter(output_filename, img.shape[1],
+                                      img.shape[0], final_palette, dpi=dpi,
+                                      level=level, bits=bits,
+                                      strategy=strategy,
+                                      filter_type=filter_type)
+        writer.write_rows(labels)
+        if pdf is not None:
+            pdf.write_rows(labels)
+
+    writer.close()
+    if pdf is not None:
+        pdf.end_page()
+
+    # includes the labeling of the strips (apply_palette events)
+    Instrumentation.record('save', time.time()-start,
+                           pixels=img.shape[0]*img.shape[1],
+                           bytes=writer.bytes_written)
 
-    for input_filename in filenames:
+######################################################################
 
-        img, _ = load(input_filename)
-        if img is None:
-            continue
+def reservoir_add(reservoir, samples, capacity, rng):
 
-        if not options.quiet:
-            print('  processing {}...'.format(input_filename))
+    '''Add samples to a fixed-size uniform random subset (reservoir) of
+all samples added so far. The reservoir is None (empty) or a tuple
+(samples, keys): every sample gets a random key and the capacity
+samples with the smallest keys are kept. At no time more than the
+reservoir and one batch of samples are held in memory. Returns the new
+reservoir.'''
 
-        samples = sample_pixels(img, options)
-        input_filenames.append(input_filename)
-        all_samples.append(samples)
+    random = getattr(rng, 'random', None) or rng.random_sample
+    keys = random(len(samples))
 
-    num_inputs = len(input_filenames)
+    if reservoir is not None:
+        samples = np.vstack((reservoir[0], samples))
+        keys = np.concatenate((reservoir[1], keys))
 
-    all_samples = [s[:int(round(float(s.shape[0])/num_inputs))]
-                   for s in all_samples]
+    if len(samples) > capacity:
+        keep = np.argpartition(keys, capacity)[:capacity]
+        samples, keys = samples[keep], keys[keep]
 
-    all_samples = np.vstack(tuple(all_samples))
+    return samples, keys
+
+######################################################################
+
+def sample_page(job):
+
+    '''Load and sample a single page for the global palette. Executed
+in a worker process of get_global_palette(), so it has to be a
+module-level function. job is a tuple (index, input_filename,
+options); returns (index, samples, events), samples is None if the
+page could not be loaded, events are the instrumentation events of
+the page (see lib.Instrumentation.capture()).'''
+
+    index, input_filename, options = job
+
+    # every page gets its own seed, otherwise pages of the same size
+    # would be sampled at the same positions
+    seed = getattr(options, 'sample_seed', None)
+    rng = get_rng(None if seed is None else [seed, index])
+
+    with Instrumentation.capture() as events, \
+            Instrumentation.for_page(input_filename):
+
+        samples = sample_at_decode(input_filename, -1, options, rng)
+
+        if samples is None:
+            img, _ = load(input_filename, -1)
+            if img is not None:
+                samples = sample_pixels(img, options, rng)
+
+    return index, samples, events
+
+######################################################################
 
-    global_palette = get_palette(all_samples, options)
+def worker_pool(processes):
+
+    '''Create a pool of processes worker processes for the pages. Where
+available the workers are started by a fork server (or spawned as a
+fresh interpreter) instead of forking the calling process: the GUI
+creates the pool in a worker thread while preview and thumbnail
+threads load images with Qt, and a lock held by one of them at the
+moment of the fork would stay locked in the child, which then hangs
+in load(). Python 2 can only fork; there the pool must be created
+while no other thread is loading images.
+
+    '''
+
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing.Pool(processes=processes)
+
+    methods = multiprocessing.get_all_start_methods()
+    method = 'forkserver' if 'forkserver' in methods else 'spawn'
+
+    return get_context(method).Pool(processes=processes)
+
+######################################################################
+
+def get_global_palette(filenames, options, workers=None, cache=None,
+                       capacity=None):
+
+    '''Fetch the global palette for a series of input files by merging
+their samples together. The pages are loaded and sampled by a pool of
+workers worker processes (default: one per cpu core), the samples are
+collected in a reservoir of capacity samples (default
+GLOBAL_PALETTE_SAMPLES), so the memory use does not grow with the
+number of pages.
+
+The palette is stored in the DiskCache cache (if given), a run with
+the same files and options starts labeling immediately.
+
+    '''
+
+    if capacity is None:
+        capacity = GLOBAL_PALETTE_SAMPLES
+
+    key = None
+    if cache is not None:
+        try:
+            key = global_palette_key(filenames, options)
+        except OSError:
+            key = None   # missing files are reported by load() below
+
+    if key is not None:
+        cached = cache.get_arrays(key)
+        if cached is not None:
+            if not options.quiet:
+                print('using cached global palette\n')
+            return ([filenames[i] for i in cached['loaded']],
+                    cached['palette'])
+
+    if not options.quiet:
+        print('building global palette...')
+
+    jobs = [(index, input_filename, options)
+            for index, input_filename in enumerate(filenames)]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+
+    pool = None
+    if workers > 1:
+        pool = worker_pool(workers)
+        results = pool.imap(sample_page, jobs)   # in order, reproducible
+    else:
+        results = (sample_page(job) for job in jobs)
+
+    rng = get_rng(getattr(options, 'sample_seed', None))
+    reservoir = None
+    loaded = []
+
+    try:
+        for index, samples, events in results:
+            Instrumentation.dispatch(events)
+            if samples is None:
+                continue
+            if not options.quiet:
+                print('  processed {}'.format(filenames[index]))
+            loaded.append(index)
+            reservoir = reservoir_add(reservoir, samples, capacity, rng)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if reservoir is None:
+        raise IOError('none of the input files could be opened')
+
+    global_palette = get_palette(reservoir[0], options)
+
+    if key is not None:
+        cache.put_arrays(key, palette=global_palette,
+                         loaded=np.array(loaded, dtype=np.int64))
 
     if not options.quiet:
         print('  done\n')
 
-    return input_filenames, global_palette
+    return [filenames[i] for i in loaded], global_palette
 
 ######################################################################
 
@@ -530,12 +1493,16 @@ def emit_pdf(outputs, options):
     if not options.quiet:
         print('running PDF command "{}"...'.format(cmd_print))
 
+    start = time.time()
+
     try:
         result = subprocess.call(shlex.split(cmd))
     except OSError:
         result = -1
 
     if result == 0:
+        Instrumentation.record('pdf', time.time()-start, pages=len(outputs),
+                               bytes=os.path.getsize(options.pdfname))
         if not options.quiet:
             print('  wrote', options.pdfname)
     else:
@@ -551,63 +1518,157 @@ def notescan_main(options):
 
     outputs = []
 
+    collector = None
+    if getattr(options, 'timings', False):
+        collector = Instrumentation.EventCollector()
+        Instrumentation.add_listener(collector)
+
     do_global = options.global_palette and len(filenames) > 1
 
+    disk_cache = None
+    if options.cache_dir:
+        disk_cache = DiskCache(options.cache_dir)
+
     if do_global:
-        filenames, palette = get_global_palette(filenames, options)
+        filenames, palette = get_global_palette(filenames, options,
+                                                options.workers, disk_cache)
 
     do_postprocess = bool(options.postprocess_cmd)
 
-    for input_filename in filenames:
+    # without a PDF command the pages are written to the PDF as soon
+    # as they are labeled
+    pdf = None
+    if not options.pdf_cmd:
+        pdf = PdfWriter(options.pdfname)
+
+    strip_height = options.strip_height
+
+    # PNG encoding and postprocessing run in the background while the
+    # next page is processed, at most one page per thread waits
+    threads = options.encode_threads
+    if threads <= 0 and do_postprocess:
+        threads = multiprocessing.cpu_count()
+    encoder = None
+    pending = []
+    if threads > 0:
+        encoder = ThreadPool(threads)
+
+    # labels with a global palette depend on all pages, only single pages
+    # are cached (and in strip mode the labels are never complete)
+    cache = None
+    if not do_global and not strip_height and disk_cache is not None:
+        cache = labels_cache(disk_cache.directory)
 
-        img, dpi = load(input_filename)
-        if img is None:
-            continue
+    for input_filename in filenames:
 
         output_filename = '{}{:04d}.png'.format(
             options.basename, len(outputs))
 
-        if not options.quiet:
-            print('opened', input_filename)
+        Instrumentation.set_page(input_filename)
+
+        cached = None
+        if cache is not None:
+            key = disk_key(input_filename, options, 'labels')
+            cached = cache.get_arrays(key)
 
-        if not do_global:
-            samples = sample_pixels(img, options)
-            palette = get_palette(samples, options)
+        if cached is not None:
 
-        labels = apply_palette(img, palette, options)
+            if not options.quiet:
+                print('cached', input_filename)
+
+            labels, palette = cached['labels'], cached['palette']
+            dpi = (300, 300)
+
+        else:
 
-        save(output_filename, labels, palette, dpi, options)
+            if not do_global:
+                palette = None
+                samples = sample_at_decode(input_filename, -1, options)
+                if samples is not None:
+                    palette = get_palette(samples, options)
+
+            img, dpi = load(input_filename, -1)
+            if img is None:
+                continue
+
+            if not options.quiet:
+                print('opened', input_filename)
+
+            if strip_height:
+
+                if palette is None:
+                    samples = sample_pixels_strips(img, options, strip_height)
+                    palette = get_palette(samples, options)
+
+                save_strips(output_filename, img, palette, dpi, options,
+                            strip_height, pdf)
+                labels = None
 
-        if do_postprocess:
-            post_filename = postprocess(output_filename, options)
-            if post_filename:
-                output_filename = post_filename
             else:
-                do_postprocess = False
 
-        outputs.append(output_filename)
+                if palette is None:
+                    samples = sample_pixels(img, options)
+                    palette = get_palette(samples, options)
+
+                labels = apply_palette(img, palette, options)
+
+            if cache is not None:
+                cache.put_arrays(key, labels=labels, palette=palette)
+
+        job = (output_filename, labels, palette, dpi, options)
+        if encoder is not None:
+            output = encoder.apply_async(
+                Instrumentation.bind_page(write_output, input_filename), job)
+            pending.append(output)
+            while len(pending) > threads:
+                pending.pop(0).wait()
+        else:
+            output = write_output(*job)
+
+        if labels is not None and pdf is not None:
+            with Instrumentation.timer('pdf', pages=1) as counters:
+                before = pdf.bytes_written
+                pdf.add_page(labels, finalize_palette(palette, options), dpi)
+                counters['bytes'] = pdf.bytes_written - before
+
+        outputs.append(output)
 
         if not options.quiet:
             print('  done\n')
 
-    emit_pdf(outputs, options)
+    Instrumentation.set_page(None)
+
+    if encoder is not None:
+        outputs = [output.get() for output in outputs]
+        encoder.close()
+        encoder.join()
+
+    if do_postprocess and not options.quiet:
+        print(postprocess_report([result for _, result in outputs]))
+
+    outputs = [filename for filename, _ in outputs]
+
+    if pdf is not None:
+        pdf.close()
+        if not options.quiet:
+            print('wrote', options.pdfname)
+    else:
+        emit_pdf(outputs, options)
+
+    if collector is not None:
+        Instrumentation.remove_listener(collector)
+        print(Instrumentation.format_summary(
+            Instrumentation.summarize(collector.events)))
 
 ######################################################################
 
-def create_preview(input_filename, height, options):
-    '''
-    Create a preview using the given parameters of param "options".
-    :param input_filename: valid Filename (String)   Note: This will not be checked
-    :param options: Namespace object like from args.parse()
-    :return: QImage-Object
-    '''
-    #print("Loading Preview for:", input_filename, height, options)
-    img, dpi = load(input_filename, height)
+def finalize_palette(palette, options):
 
-    samples = sample_pixels(img, options)
-    palette = get_palette(samples, options)
+    '''Apply the output-only palette adjustments: optionally saturate
+the palette by mapping the smallest color component to zero and the
+largest one to 255, and optionally set the background to pure white.
 
-    labels = apply_palette(img, palette, options)
+    '''
 
     if options.saturate:
         palette = palette.astype(np.float32)
@@ -620,22 +1681,79 @@ def create_preview(input_filename, height, options):
         palette = palette.copy()
         palette[0] = (255, 255, 255)
 
+    return palette
+
+######################################################################
+
+def labels_to_qimage(labels, palette):
+
+    '''Wrap a label/palette pair into an indexed QImage. The palette is
+used as given, see finalize_palette().'''
+
     QtImage = q2n.gray2qimage(labels, False)
 
-    nestedColorMap = palette
     colors = []
-    for color in nestedColorMap:
+    for color in palette:
         r, g, b = color
         colors.append(qRgb(r, g, b))
     QtImage.setColorTable(colors)
 
     return QtImage
 
+######################################################################
+
+def render_page(input_filename, height, options, init_palette=None,
+                palette=None):
+
+    '''Run the complete pipeline (load, sample, palette, labeling) for
+a single page. Only numpy arrays are returned, so this can be used
+from worker processes.
+
+    :param input_filename: valid Filename (String)   Note: This will not be checked
+    :param height: maximum height of the result, -1 for full size
+    :param options: Namespace object like from args.parse()
+    :param init_palette: previous palette of this page to warm-start the clustering (see get_palette())
+    :param palette: use this palette (e.g. computed from a smaller version of the page) and only do the labeling
+    :return: labels (uint8 array), palette (unfinalized uint8 array)
+    '''
+
+    if palette is None:
+        samples = sample_at_decode(input_filename, height, options)
+        if samples is not None:
+            palette = get_palette(samples, options,
+                                  init_palette=init_palette)
+
+    img, dpi = load(input_filename, height)
+    if img is None:
+        raise IOError('cannot read image {}'.format(input_filename))
+
+    if palette is None:
+        samples = sample_pixels(img, options)
+        palette = get_palette(samples, options, init_palette=init_palette)
+
+    labels = apply_palette(img, palette, options)
+
+    return labels, palette
+
+######################################################################
+
+def create_preview(input_filename, height, options):
+    '''
+    Create a preview using the given parameters of param "options".
+    :param input_filename: valid Filename (String)   Note: This will not be checked
+    :param options: Namespace object like from args.parse()
+    :return: QImage-Object
+    '''
+    #print("Loading Preview for:", input_filename, height, options)
+    labels, palette = render_page(input_filename, height, options)
+
+    return labels_to_qimage(labels, finalize_palette(palette, options))
+
 
 def main():
     '''Parse args and call notescan_main().'''
     notescan_main(options=get_argument_parser().parse_args())
 
 if __name__ == '__main__':
-    #main()
-    print(get_argument_parser().parse_args())
+    # run from the directory of noteshrinker-qt.py: python -m lib.noteshrink
+    main()
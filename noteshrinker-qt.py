@@ -32,14 +32,28 @@
 #######################################################################################################################
 
 
-import sys, os, logging, logging.handlers, io, argparse, time, signal, hashlib, json
-import res.res
-from argparse import Namespace
+import sys, os, logging, logging.handlers, io, argparse, time, signal, hashlib, json, importlib, threading
+STARTUP_TIME = time.time()   # reference of the startup times (see MainWindow.report_startup)
+if __name__ == "__main__" and "--batch" in sys.argv[1:]:
+    # headless mode, nothing of the GUI is imported (see lib/BatchMode.py)
+    import lib.BatchMode
+    # worker processes which are not forked (see lib.noteshrink.worker_pool) import the main module again: this
+    # has to be lib.BatchMode, this script would load the GUI in every worker
+    sys.modules["__main__"] = lib.BatchMode
+    sys.exit(lib.BatchMode.batch_main([arg for arg in sys.argv[1:] if arg != "--batch"]))
+import res
+RESOURCES = res.register_resources()   # the binary resources.rcc, res.res only as fallback
+from copy import deepcopy
 from ui.mainwindow import Ui_MainWindow_noteshrinker_qt
 from lib.FileSystemView import LM_QFileSystemModel, FileIconProvider
-from lib.noteshrink import create_preview
+from lib.RenderCache import PaletteCache, palette_key, disk_key
+from lib.PreviewService import PreviewService, PreviewCancelled
+from lib.OutputWriter import write_outputs
+from lib.RunReport import RunReport
+import lib.Instrumentation as Instrumentation
 from PyQt4.QtCore import *  #TODO: Add Pyqt5 Support
 from PyQt4.QtGui import *
+IMPORT_TIME = time.time()
 
 
 __author__ = 'matthias laumer, matthias.laumer@web.de'
@@ -53,6 +67,16 @@ cwd = os.path.dirname(os.path.realpath(__file__))      # gives the path, where t
 
 _ = lambda x : x
 
+PROGRESSIVE_FACTOR = 8    # the rough preview (progressive mode) is computed at 1/8 of the preview height
+PREVIEW_KMEANS_METHOD = "minibatch"   # clustering of the previews (fast slider tweaks), the outputs use the options
+# Python 2 can only fork the worker processes of an output run (see lib.noteshrink.worker_pool): while a run is
+# active no previews and thumbnails are computed, a Qt lock held by one of their threads would hang the workers
+FORK_ONLY = sys.version_info < (3, 4)
+
+# The processing core is not imported before the window shows (see the import budget in README.md). These modules
+# are imported in a background thread after the first paint, so the first preview does not wait for them.
+PREWARM_MODULES = ("numpy", "scipy.cluster.vq", "lib.noteshrink", "lib.BatchEngine", "lib.PdfWriter")
+
 
 def setupLogger(console=True, File=False, Variable=False, Filebackupcount=0):
     '''
@@ -110,6 +134,27 @@ def sigint_handler(*args):
     sys.exit(0)
 
 
+def prewarm_imports(modules=PREWARM_MODULES):
+    '''
+    Import the given modules (executed in a background thread, see MainWindow.paintEvent). An import which fails
+    here is only logged, it fails again with the real error where the module is used.
+    '''
+    start = time.time()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            logger.exception("Prewarming {0} failed".format(name))
+    logger.debug("Prewarmed imports in {0:.3f} s".format(time.time() - start))
+
+
+def log_stage_event(event):
+    '''
+    Listener of lib.Instrumentation: every finished stage of the pipeline (load, kmeans, save, ...) is logged.
+    '''
+    logger.debug(Instrumentation.format_event(event))
+
+
 def excepthook(excType, excValue, traceback):
     '''
     This handler is called whenever an unexpected failure occurs
@@ -120,12 +165,29 @@ def excepthook(excType, excValue, traceback):
                  exc_info=(excType, excValue, traceback))
 
 
+def preview_md5(options):
+    '''
+    The md5 hash of the options which change the look of a preview. It is stored next to the preview image to detect
+    outdated previews.
+    :param options: Namespace-Object
+    :return: str (hexdigest)
+    '''
+    complete_data = options.__dict__
+    relavant_data = {}
+    relavant_data.update({'sat_threshold': complete_data.get('sat_threshold')})
+    relavant_data.update({'value_threshold': complete_data.get('value_threshold')})
+    relavant_data.update({'sample_fraction': complete_data.get('sample_fraction')})
+    relavant_data.update({'num_colors': complete_data.get('num_colors')})
+    return hashlib.md5(json.dumps(relavant_data, sort_keys=True)).hexdigest()
+
+
 class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
     '''
     All the visible aspects which have to be handled are in this class.
     '''
     sig_setProgressValue = pyqtSignal(int)
     sig_settingsChanged = pyqtSignal()
+    sig_stageEvent = pyqtSignal(QString)   # text of a finished pipeline stage (see on_stage_event)
 
     def __init__(self, parent=None):
         '''
@@ -152,6 +214,14 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         self.resize_trigger.timeout.connect(self.update_preview)
 
         self.block_trigger = False
+        self.workers = None         # number of processes used by generateOutput, None means one per cpu core
+        self.go_thread = None       # WorkerThread of a running output generation (see on_go)
+        self.preview_service = PreviewService(self.get_preview, self)   # computes previews in the background
+        self.progressive = True     # show a rough preview first, see get_preview
+        # persistent cache for palettes, labels (previews and output) across sessions; the same instance as the one of
+        # the thumbnails, so the size of the directory is tracked (and capped) in one place
+        self.disk_cache = self.tW_workbench.disk_cache
+        self.palette_cache = PaletteCache(disk=self.disk_cache)   # palettes, reused for other preview heights
         self.setWindowIcon(self.generateIcon())
         self.setupUi_Widgets()
         self.createActions()
@@ -162,6 +232,9 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         self.__moveCenter()
 
         QTimer.singleShot(1, lambda: self.sig_setProgressValue.emit(0))
+        self.startup_timing = False   # print the startup times and quit after the first paint (--startup-timing)
+        self.created_time = time.time()
+        self.first_paint_time = None
 
     ##################################################################################################STARTUP Actions:
 
@@ -214,6 +287,12 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         self.hS_percentage_of_pixels.setTickPosition(QSlider.TicksBelow)
         self.hS_percentage_of_pixels.setPageStep(2)
 
+        # one palette for all pages (noteshrink -g), computed from the samples of all pages before the output
+        self.cB_global_palette = QCheckBox(self.tr("one palette for all pages"), self.gB_settings)
+        self.cB_global_palette.setToolTip(self.tr("All pages get the same colors (uses the settings of the first "
+                                                  "page)"))
+        self.verticalLayout.addWidget(self.cB_global_palette)
+
         #self.hS_background_saturation.setValue()
         #self.hS_background_threshold.setValue()
 
@@ -304,6 +383,11 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
                                  triggered=self.tW_workbench.moveDown)
         self.ACTmoveDown.setIconVisibleInMenu(True)
 
+        self.ACTrunReport = QAction(self.tr(u"Write performance &report"),self,
+                                 checkable=True,
+                                 statusTip=self.tr(u"Write a JSON and HTML report (time per page and stage, sizes, "
+                                                   u"memory) next to the outputs"))
+
     def createMenus(self):
         """
         Create the Mainwindow meneu   " Datei  |   Bearbeiten   |   Extras   |   Hilfe "
@@ -321,6 +405,7 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         self.editMenu.addAction(self.ACTmoveDown)
 
         self.extrasMenu = self.menuBar().addMenu(self.tr("&Extras"))
+        self.extrasMenu.addAction(self.ACTrunReport)
 
         self.menuBar().addSeparator()    # seems like there is no effect on Linux. (maybe on Windows..)
 
@@ -390,9 +475,9 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         except IndexError:
             self.gB_settings.setEnabled(False)
 
-        if self.cB_create_images.isChecked() or \
-                self.cB_create_merged_pdf.isChecked() or \
-                self.cB_create_single_pdf.isChecked():
+        if self.go_thread is None and (self.cB_create_images.isChecked() or
+                                       self.cB_create_merged_pdf.isChecked() or
+                                       self.cB_create_single_pdf.isChecked()):
             self.pB_go.setEnabled(True)
         else:
             self.pB_go.setEnabled(False)
@@ -419,8 +504,14 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         self.cB_create_merged_pdf.stateChanged.connect(self.checkActions)    #enable or disable the go-button
         self.sig_setProgressValue.connect(self.setProgressValue)
         self.sig_settingsChanged.connect(self.on_sig_settingsChanged)
+        self.sig_stageEvent.connect(self.showStatusBarText)
+        Instrumentation.add_listener(self.on_stage_event)
         self.splitter.splitterMoved.connect(self.handleSplitter)
         self.pB_go.clicked.connect(self.on_go)
+        self.preview_service.sig_previewReady.connect(self.on_preview_ready)
+        self.preview_service.sig_previewFailed.connect(self.on_preview_failed)
+        self.preview_service.sig_previewCancelled.connect(self.on_preview_cancelled)
+        self.preview_service.sig_previewPartial.connect(self.on_preview_partial)
         #self.lE_filename_base.textChanged.connect(self.sig_settingsChanged.emit)
         self.lE_filename_base.editingFinished.connect(self.sig_settingsChanged.emit)
 
@@ -459,6 +550,15 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
 
         QCloseEvent.accept()              # close Window
 
+    def paintEvent(self, qPaintEvent):
+        if self.first_paint_time is None:
+            self.first_paint_time = time.time()
+            QTimer.singleShot(0, self.report_startup)   # after the paint event is processed completely
+            prewarm = threading.Thread(target=prewarm_imports, name="prewarm")
+            prewarm.daemon = True   # does not keep the application alive
+            prewarm.start()
+        return QMainWindow.paintEvent(self, qPaintEvent)
+
     def resizeEvent(self, qResizeEvent):
         if self.resize_trigger.isActive():
             self.resize_trigger.stop()   #reset a running timer, wait 500ms and after this, trigger the new preview
@@ -549,8 +649,11 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
     @pyqtSlot()                       #caller:      tW_workbench.itemSelectionChanged
     def update_preview(self):
         print("Update Preview")
+        if FORK_ONLY and self.go_thread is not None:
+            return   # paused during the output run, on_go_finished updates the preview
         # do not provide a preview area if more than one is selected or if nothing is selected
         if len(self.tW_workbench.getselectedRowsFast()) > 1 or len(self.tW_workbench.getselectedRowsFast()) == 0:
+            self.preview_service.cancel()   # nothing to show, running previews are only stored
             #delete preview and hide preview-area
             if self.gB_preview.isVisible():
                 self.gB_preview.hide()
@@ -571,34 +674,22 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         if not pictureItem: return False
         #=================================================== Update Preview ==========================================#
         options = nameItem.data(Qt.UserRole).toPyObject()    # Namespace-Object
-        preview_image, md5_read = pictureItem.data(Qt.UserRole).toPyObject()    # [QImage, Namespace-Object]
+        # [QImage, md5, palette, height it was computed for]
+        preview_image, md5_read, palette, preview_height = pictureItem.data(Qt.UserRole).toPyObject()
 
-        self.sig_setProgressValue.emit(-1)   # switch prograss bar to pulsing
-        complete_data = options.__dict__
-        relavant_data = {}
-        relavant_data.update({'sat_threshold': complete_data.get('sat_threshold')})
-        relavant_data.update({'value_threshold': complete_data.get('value_threshold')})
-        relavant_data.update({'sample_fraction': complete_data.get('sample_fraction')})
-        relavant_data.update({'num_colors': complete_data.get('num_colors')})
-        md5_needed = hashlib.md5(json.dumps(relavant_data, sort_keys=True)).hexdigest()
-
-        if md5_read != md5_needed:
+        md5_needed = preview_md5(options)
+
+        # a preview is recomputed if the options changed or the window has grown (cheap, the palette is cached)
+        if md5_read != md5_needed or preview_height < self.height():
             logger.debug("Creating new Preview-Image for file: {0}".format(options.filenames[0].encode("utf-8")))
             height = self.height()  # limit the size of the picture to the viewport otherwise this can take really long
-
-            thread = WorkerThread(self.get_preview, options, height)
-            thread.start()
-            while not thread.isFinished():
-                app.processEvents()   # update the viewport during calculation and avoid inresponsive window
-            preview_image, md5_new = thread.result()
-            # store the QImage and coresponding md5 hash for later use
-            pictureItem.setData(Qt.UserRole, [preview_image, md5_new])
+            self.sig_setProgressValue.emit(-1)   # switch prograss bar to pulsing
+            # computed in the background, see on_preview_ready. The palette of the last preview (if any) is used to
+            # warm-start the clustering
+            self.preview_service.request(options.filenames[0], options, height, palette)
         if preview_image is not None:
-            pixmap = QPixmap.fromImage(preview_image).scaledToHeight(self.height() / 2.5, Qt.SmoothTransformation)
-            self.lbl_preview.setPixmap(pixmap)
-            if self.gB_preview.isHidden():
-                self.gB_preview.setVisible(True)
-            self.sig_setProgressValue.emit(100)   # switch prograss bar to finished
+            # show the existing preview (maybe outdated) until the new one is ready
+            self.show_preview(preview_image)
 
         #================================================== Update Settings =====================================#
         self.block_trigger = True  # stop the trigger for changed values otherwise one additional preview is calculated
@@ -612,6 +703,57 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         self.hS_background_threshold.setValue(options.value_threshold * 100)   # transform percent value
         self.block_trigger = False  # set the trigger active again
 
+    @pyqtSlot(object, object, bool)              # caller:      self.preview_service.sig_previewReady
+    def on_preview_ready(self, filename, result, stale):
+        '''
+        Store a computed preview at every item which shows the file with the same settings and display it if the
+        request is still the current one.
+        :param filename: options.filenames[0] of the request
+        :param result: tuple (QImage, md5, palette, height) see get_preview
+        :param stale: True if the request has been superseded in the meantime
+        '''
+        preview_image, md5_new, palette, height = result
+        for nameItem, pictureItem in zip(self.tW_workbench.get_all_items("name"),
+                                         self.tW_workbench.get_all_items("pic")):
+            options = nameItem.data(Qt.UserRole).toPyObject()
+            if options.filenames[0] == filename and preview_md5(options) == md5_new:
+                pictureItem.setData(Qt.UserRole, [preview_image, md5_new, palette, height])
+
+        selected = self.tW_workbench.get_selected_Item("name")
+        if not stale and selected and selected.data(Qt.UserRole).toPyObject().filenames[0] == filename:
+            self.show_preview(preview_image)
+        if not self.preview_service.isBusy():
+            self.sig_setProgressValue.emit(100 if not stale else 0)   # finished / hide the progressbar
+
+    @pyqtSlot(object, object)                    # caller:      self.preview_service.sig_previewPartial
+    def on_preview_partial(self, filename, result):
+        '''
+        Display a rough (intermediate) preview of the selected file. It is not stored.
+        '''
+        selected = self.tW_workbench.get_selected_Item("name")
+        if selected and selected.data(Qt.UserRole).toPyObject().filenames[0] == filename:
+            self.show_preview(result[0])
+
+    @pyqtSlot(object)                            # caller:      self.preview_service.sig_previewFailed
+    def on_preview_failed(self, filename):
+        self.showStatusBarText(self.tr("Preview could not be created!"))
+        self.on_preview_cancelled(filename)
+
+    @pyqtSlot(object)                            # caller:      self.preview_service.sig_previewCancelled
+    def on_preview_cancelled(self, filename):
+        if not self.preview_service.isBusy():
+            self.sig_setProgressValue.emit(0)   # hide the progressbar
+
+    def show_preview(self, preview_image):
+        '''
+        Display a preview image in the preview area.
+        :param preview_image: QImage
+        '''
+        pixmap = QPixmap.fromImage(preview_image).scaledToHeight(self.height() / 2.5, Qt.SmoothTransformation)
+        self.lbl_preview.setPixmap(pixmap)
+        if self.gB_preview.isHidden():
+            self.gB_preview.setVisible(True)
+
     @pyqtSlot()
     def on_sig_settingsChanged(self):
         nameItem = self.tW_workbench.get_selected_Item("name")
@@ -625,21 +767,15 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         float_sat_threshold = self.hS_background_saturation.value() / float(100)   # percentage
         float_value_threshold = self.hS_background_threshold.value() / float(100)  # percentage
 
-        # generate a new options obj
-        NEWOptions = Namespace(basename=str_basename,
-                               filenames=list_filenames,
-                               global_palette=False,
-                               num_colors=int_num_colors,
-                               pdf_cmd='convert %i %o',
-                               pdfname='{}.pdf'.format(str_basename),
-                               postprocess_cmd=None,
-                               postprocess_ext='_post.png',
-                               quiet=False,
-                               sample_fraction=float_sample_fraction,
-                               sat_threshold=float_sat_threshold,
-                               saturate=True,
-                               sort_numerically=True,
-                               value_threshold=float_value_threshold, white_bg=False)
+        # generate a new options obj (settings which are not part of the settings area are kept)
+        NEWOptions = deepcopy(OLDoptions)
+        NEWOptions.basename = str_basename
+        NEWOptions.filenames = list_filenames
+        NEWOptions.num_colors = int_num_colors
+        NEWOptions.pdfname = '{}.pdf'.format(str_basename)
+        NEWOptions.sample_fraction = float_sample_fraction
+        NEWOptions.sat_threshold = float_sat_threshold
+        NEWOptions.value_threshold = float_value_threshold
         nameItem.setData(Qt.UserRole, NEWOptions)
 
         self.update_preview()   # generate a new preview for changed options
@@ -668,18 +804,35 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         createPic = self.cB_create_images.isChecked()
         createSinglePDF = self.cB_create_single_pdf.isChecked()
         createMergedPDF = self.cB_create_merged_pdf.isChecked()
-
+        globalPalette = self.cB_global_palette.isChecked()
+        writeReport = self.ACTrunReport.isChecked()
 
         target_path = unicode(QFileDialog.getExistingDirectory(self, self.tr("Please select a folder where to save output:"),
                                                         self.lastlocation or self.picturelocation))
-        thread = WorkerThread(self.generateOutput, createPic, createSinglePDF, createMergedPDF, target_path)
+        if not target_path:
+            return   # the user aborted the dialog
+        # collect the options here, the workbench stays editable while the thread is running
+        options_list = [deepcopy(item.data(Qt.UserRole).toPyObject()) for item in self.tW_workbench.get_all_items("name")]
+        if FORK_ONLY:
+            # no image is loaded in another thread while the worker processes are forked
+            self.preview_service.cancel()
+            self.preview_service.wait()
+            self.tW_workbench.pause_thumbnails()
+        self.go_thread = WorkerThread(self.generateOutput, options_list, createPic, createSinglePDF, createMergedPDF,
+                                      target_path, globalPalette, writeReport)
+        self.go_thread.finished.connect(self.on_go_finished)
+        self.pB_go.setEnabled(False)   # only one generation at a time
         self.sig_setProgressValue.emit(-1)   # switch prograss bar to pulsing
-        thread.start()
-        while not thread.isFinished():
-            app.processEvents()   # update the viewport during calculation and avoid inresponsive window
-        #self.generateOutput(createPic, createSinglePDF, createMergedPDF, target_path)
-        self.sig_setProgressValue.emit(100)   # switch prograss bar to pulsing
+        self.go_thread.start()   # the window stays responsive, on_go_finished is called afterwards
 
+    @pyqtSlot()                                # caller             self.go_thread.finished()
+    def on_go_finished(self):
+        self.go_thread = None
+        if FORK_ONLY:
+            self.tW_workbench.resume_thumbnails()
+            self.update_preview()
+        self.checkActions()   # enables the go-button again
+        self.sig_setProgressValue.emit(100)   # switch prograss bar to finished
 
     ###################################################################################################Helper Functions
 
@@ -695,97 +848,101 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
                         break
         return selected_files
 
-    def get_preview(self, options, height):
+    def get_preview(self, options, height, init_palette=None):
         '''
         Create a (minimized) preview Image for the given options (options, includes filenames and settings for
         noteshrink...)
+        This is a generator (see PreviewService): in progressive mode a rough preview at 1/PROGRESSIVE_FACTOR of the
+        height is yielded first, its palette is reused for labeling the preview at the full height
+        (skipped if the request has been superseded in the meantime).
+        Palettes are cached by file content and options (self.palette_cache), with a known palette only the
+        labeling at the requested height is done. Finished previews are stored in self.disk_cache and reused in
+        later sessions.
         :param options: Namespace-Object from arg-parse (can be called like "options.filenames"
         :param height: the maximum height for the preview
-        :return: QImage, md5_hash(from options-obj)
+        :param init_palette: palette of the previous preview of this file, used to warm-start the clustering
+        :return: yields QImage, md5_hash(from options-obj), palette (unfinalized, for the next warm-start), height
+        '''
+        from lib.noteshrink import render_page, labels_to_qimage, finalize_palette   # see PREWARM_MODULES
+        md5_hash = preview_md5(options)   # the md5 hash of the QTablewidgetItem
+        options = deepcopy(options)
+        options.kmeans_method = PREVIEW_KMEANS_METHOD   # part of the cache keys, outputs never get these palettes
+        preview_key = disk_key(options.filenames[0], options, 'preview', height)
+        cached = self.disk_cache.get_arrays(preview_key)
+        if cached is not None:
+            # computed in an earlier session
+            labels, palette = cached['labels'], cached['palette']
+            yield labels_to_qimage(labels, finalize_palette(palette, options)), md5_hash, palette, height
+            return
+        key = palette_key(options)
+        palette = self.palette_cache.get(key)
+        if palette is not None:
+            # known palette (e.g. only the height changed): only the labeling has to be done
+            labels, palette = render_page(options.filenames[0], height, options, palette=palette)
+        elif self.progressive and height >= PROGRESSIVE_FACTOR * 16:
+            # a smaller image has fewer pixels, sample a larger fraction to get about the same number of samples
+            small_options = deepcopy(options)
+            small_options.sample_fraction = min(1.0, options.sample_fraction * PROGRESSIVE_FACTOR ** 2)
+            labels, palette = render_page(options.filenames[0], height // PROGRESSIVE_FACTOR, small_options,
+                                          init_palette)
+            self.palette_cache.put(key, palette)
+            superseded = yield labels_to_qimage(labels, finalize_palette(palette, options)), md5_hash, palette, height
+            if superseded:
+                raise PreviewCancelled()   # the palette is cached, the labeling at the full height is skipped
+            labels, palette = render_page(options.filenames[0], height, options, palette=palette)
+        else:
+            labels, palette = render_page(options.filenames[0], height, options, init_palette)
+            self.palette_cache.put(key, palette)
+        self.disk_cache.put_arrays(preview_key, labels=labels, palette=palette)
+        previewImage = labels_to_qimage(labels, finalize_palette(palette, options))
+        yield previewImage, md5_hash, palette, height
+
+    def generateOutput(self, options_list, createPic, createSinglePDF, createMergedPDF, output_dir,
+                       globalPalette=False, writeReport=False):
         '''
-        complete_data = options.__dict__
-        relavant_data = {}
-        relavant_data.update({'sat_threshold': complete_data.get('sat_threshold')})
-        relavant_data.update({'value_threshold': complete_data.get('value_threshold')})
-        relavant_data.update({'sample_fraction': complete_data.get('sample_fraction')})
-        relavant_data.update({'num_colors': complete_data.get('num_colors')})
-        md5_hash = hashlib.md5(json.dumps(relavant_data, sort_keys=True)).hexdigest()   # the md5 hash of the QTablewidgetItem
-        previewImage = create_preview(options.filenames[0], height, options)
-        return previewImage, md5_hash
-
-    def generateOutput(self, createPic, createSinglePDF, createMergedPDF, output_dir):
-
-        items = self.tW_workbench.get_all_items("name")
-        for item in items:
-            options = item.data(Qt.UserRole).toPyObject()    # Namespace-Object
-            FullsizeImage = create_preview(options.filenames[0], -1, options)
-            target_ext = os.path.splitext(os.path.basename(options.filenames[0].encode("utf-8")))[1]
-            target_ext_pdf = ".pdf"
-            if target_ext == ".gif" or target_ext == ".GIF":  #QImage does not support write to GIF
-                target_ext = ".jpg"    #TODO: Gifs have soft red background when converted to jpg or png ??
-            target_file = "{0}{1}{2}".format(os.path.splitext(os.path.basename(options.filenames[0].encode("utf-8")))[0],
-                                     options.basename,
-                                     target_ext)
-            target_file_pdf = "{0}{1}{2}".format(os.path.splitext(os.path.basename(options.filenames[0].encode("utf-8")))[0],
-                                     options.basename,
-                                     target_ext_pdf)
-
-            path_to_save = os.path.join(output_dir, str(target_file).decode("utf-8"))
-            path_to_save_pdf = os.path.join(output_dir, str(target_file_pdf).decode("utf-8"))
-            logger.info("Save file {0} to {1}".format(options.filenames[0].encode("utf-8"),
-                                                          path_to_save.encode("utf-8")))
-
-            if createPic:
-                FullsizeImage.save(path_to_save)
-
-            if createSinglePDF:
-                print("single")
-                printer = QPrinter()
-                printer.setPageSize(QPrinter.A4)
-                printer.setOutputFormat(QPrinter.PdfFormat)
-                printer.setOutputFileName(path_to_save_pdf)
-                painter = QPainter(printer)
-                painter.setRenderHint(QPainter.Antialiasing)
-                rect = painter.viewport()
-                size = FullsizeImage.size()
-                size.scale(rect.size(), Qt.KeepAspectRatio)
-                painter.setViewport(rect.x(), rect.y(),
-                size.width(), size.height())
-                painter.setWindow(FullsizeImage.rect())
-                painter.drawImage(0, 0, FullsizeImage)
-                painter.end()
-                del printer
-
-        if createMergedPDF:
-            print("Merged")
-            printer = QPrinter()
-            printer.setPageSize(QPrinter.A4)
-            printer.setOutputFormat(QPrinter.PdfFormat)
-
-            target_ext = ".pdf"
-            target_file = "{0}{1}".format("merged",target_ext)
-            path_to_save = os.path.join(output_dir, str(target_file).decode("utf-8"))
-
-            printer.setOutputFileName(path_to_save)
-            painter = QPainter(printer)
-            painter.setRenderHint(QPainter.Antialiasing)
-            rect = painter.viewport()
-
-            for i, item in enumerate(items):
-                options = item.data(Qt.UserRole).toPyObject()    # Namespace-Object
-                FullsizeImage = create_preview(options.filenames[0], -1, options)
-                size = FullsizeImage.size()
-                size.scale(rect.size(), Qt.KeepAspectRatio)
-                painter.setViewport(rect.x(), rect.y(), size.width(), size.height())
-                painter.setWindow(FullsizeImage.rect())
-                painter.drawImage(0, 0, FullsizeImage)
-                if i < (len(items) -1):
-                    printer.newPage()
-
-            painter.end()
+        Create the requested outputs for all given pages (see lib.OutputWriter.write_outputs, the batch mode uses
+        the same function).
+        :param options_list: list of Namespace-Objects (one per page, in the order of the workbench)
+        :param globalPalette: True to use one palette (from the samples of all pages) for every page
+        :param writeReport: True to write a performance report (report_<date>_<time>.json/.html) to output_dir
+        :return: dict, summary of the run
+        '''
+        if not writeReport:
+            return write_outputs(options_list, output_dir, createPic, createSinglePDF, createMergedPDF, globalPalette,
+                                 self.workers, self.disk_cache, self.report_batch_progress)
 
+        report = RunReport(self.workers)
+        Instrumentation.add_listener(report)
+        try:
+            summary = write_outputs(options_list, output_dir, createPic, createSinglePDF, createMergedPDF,
+                                    globalPalette, self.workers, self.disk_cache, self.report_batch_progress)
+        finally:
+            Instrumentation.remove_listener(report)
+        report.finish(summary)
+        report_name = os.path.join(output_dir, time.strftime("report_%Y%m%d_%H%M%S", time.localtime(report.started)))
+        report.write_json(report_name + ".json")
+        report.write_html(report_name + ".html")
+        logger.info(u"Wrote performance report {0}.json".format(report_name))
+        return summary
+
+    def on_stage_event(self, event):
+        '''
+        Listener of lib.Instrumentation, shows the finished stages of previews and outputs in the statusbar.
+        (thread-safe, called in the thread which finished the stage, the text is transported with a signal)
+        :param event: Instrumentation.Event
+        '''
+        self.sig_stageEvent.emit(Instrumentation.format_event(event))
 
-    @pyqtSlot()
+    def report_batch_progress(self, done, total):
+        '''
+        Progress callback of the BatchEngine, forwards the per-page progress to the progressbar. (thread-safe, because
+        the value is transported with a signal)
+        :param done: number of finished pages
+        :param total: number of all pages
+        '''
+        self.sig_setProgressValue.emit(max(1, min(99, 100 * done // total)))   # 0 hides and 100 finishes the bar
+
+    @pyqtSlot(QString)                           # caller:      self.sig_stageEvent
     def showStatusBarText(self, text, time=5000):
         """
         Show the "text" for "5000" ms in statusbar
@@ -863,6 +1020,21 @@ class MainWindow(QMainWindow, Ui_MainWindow_noteshrinker_qt):
         else:
             return 1       # Result Button 2 (Cancel)
 
+    def report_startup(self):
+        '''
+        Log the startup times (seconds since the script started). With --startup-timing they are printed as JSON
+        and the application quits (see bench/bench_startup.py).
+        '''
+        times = {"resources": RESOURCES,
+                 "imports": round(IMPORT_TIME - STARTUP_TIME, 4),
+                 "window": round(self.created_time - STARTUP_TIME, 4),
+                 "first_paint": round(self.first_paint_time - STARTUP_TIME, 4)}
+        logger.info("Startup times: {0}".format(times))
+        if self.startup_timing:
+            print(json.dumps(times, sort_keys=True))
+            sys.stdout.flush()
+            QApplication.quit()
+
     def dummy(self):
         print("DUMMY: Not implemented yet!")
 
@@ -891,9 +1063,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='*** '+__title__+' ***  by Matthias Laumer')
     parser.add_argument("-d", "--debug", action='store_true', help='Debug-Mode.',
                         required=False)
+    parser.add_argument("--startup-timing", action='store_true', required=False,
+                        help='print the startup times (imports, window created, first paint) as JSON and quit')
     args = vars(parser.parse_args())
     ############################################################################################################# Logger
     setupLogger(console=True, File=True, Filebackupcount=1, Variable=False)
+    Instrumentation.add_listener(log_stage_event)
     sys.excepthook = excepthook  # log uncaught exceptions to the log-file
 
     ################################################################################################### SIGTERM Handling
@@ -921,6 +1096,7 @@ if __name__ == "__main__":
     app.installTranslator(mytranslator)
 
     mainwindow = MainWindow()
+    mainwindow.startup_timing = args["startup_timing"]
     mainwindow.show()
     sys.exit(app.exec_())
 
@@ -1 +1,24 @@
 __author__ = 'matthias'
+
+'''
+Qt resources (icons) of the application. They are registered from the binary resources.rcc, Qt maps the file into
+memory and reads an icon only when it is used. The pyrcc module res.res (~1.2 MB of python source, compiled and
+copied into memory on import) is only the fallback when resources.rcc is missing, see make_rcc.py.
+'''
+
+import os
+
+RCC_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources.rcc')
+
+
+def register_resources(rcc_filename=RCC_FILENAME):
+    '''
+    Make the icons available as ":/<alias>" (see resources.qrc). Must be called before the first icon is loaded.
+    :param rcc_filename: binary resource file
+    :return: "rcc" or "py", the way the resources were registered
+    '''
+    from PyQt4.QtCore import QResource
+    if os.path.isfile(rcc_filename) and QResource.registerResource(rcc_filename):
+        return "rcc"
+    import res.res   # registers itself on import
+    return "py"
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Build res/resources.rcc, the binary resource file registered at startup (see res.register_resources), from the
+pyrcc module res/res.py:
+
+    python res/make_rcc.py
+
+The three tables of res.py (tree, names, data) are exactly the sections of a binary resource file, so they are only
+copied behind a "qres" header. Nothing is imported, PyQt4 is not needed. With the icons at hand
+"rcc -binary res/resources.qrc -o res/resources.rcc" gives the same result.
+'''
+
+from __future__ import print_function
+
+import ast
+import os
+import struct
+import sys
+
+RES_DIR = os.path.dirname(os.path.abspath(__file__))
+HEADER_SIZE = 20    # magic, version, tree offset, data offset, names offset
+
+
+def read_tables(filename):
+    '''
+    :param filename: pyrcc generated python file
+    :return: dict name > bytes of qt_resource_struct, qt_resource_name and qt_resource_data
+    '''
+    with open(filename, 'rb') as f:
+        module = ast.parse(f.read(), filename)
+    tables = {}
+    for node in module.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in ('qt_resource_struct', 'qt_resource_name', 'qt_resource_data'):
+                value = ast.literal_eval(node.value)
+                if not isinstance(value, bytes):
+                    value = value.encode('latin-1')   # python 3 reads the escaped bytes as a str
+                tables[name] = value
+    return tables
+
+
+def make_rcc(py_filename, rcc_filename):
+    '''
+    Write the binary resource file (format version 1, like Qt 4 writes it).
+    :return: size of the file in bytes
+    '''
+    tables = read_tables(py_filename)
+    tree, names, data = tables['qt_resource_struct'], tables['qt_resource_name'], tables['qt_resource_data']
+    tree_offset = HEADER_SIZE
+    data_offset = tree_offset + len(tree)
+    names_offset = data_offset + len(data)
+    header = b'qres' + struct.pack('>IIII', 1, tree_offset, data_offset, names_offset)
+    with open(rcc_filename, 'wb') as f:
+        f.write(header + tree + data + names)
+    return names_offset + len(names)
+
+
+if __name__ == '__main__':
+    size = make_rcc(os.path.join(RES_DIR, 'res.py'), os.path.join(RES_DIR, 'resources.rcc'))
+    print('wrote resources.rcc ({0} bytes)'.format(size))
+    sys.exit(0)